@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+    This module times the stages of run.py on a synthetic corpus, see
+    benchmarks/synthetic_corpus.py, and compares the times to a stored
+    baseline so that performance changes can be measured.
+
+    Benchmarks:
+    make_matching_maps
+    generate_audio: copies the audio, or converts it with --wave
+    generate_txt_files
+    standardize_files: through map_and_standardize_filenames
+    rss_feed_length: RSSFeedsHandler over feeds served by a local http server
+    import_run: importing run.py in a new interpreter
+    run_help: python run.py -h
+
+    Importing run.py must not import any of HEAVY_MODULES, they are loaded
+    by the stages that use them. One that is counts as a regression.
+
+    Every benchmark runs --repeat times on a fresh output folder and the
+    fastest time is kept.
+
+    Functionality:
+    run
+    python -m benchmarks.run_benchmarks --scale small --save_baseline
+
+    on the code to compare against, which writes benchmarks/baseline.json,
+    and then
+
+    python -m benchmarks.run_benchmarks --scale small
+
+    which prints the times next to the baseline and exits with 1 if any
+    benchmark is more than --tolerance slower. Baselines are per machine,
+    compare runs on the same host only.
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from functools import partial
+import argparse
+import http.server
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchmarks.synthetic_corpus import make_corpus, make_feed
+
+BASELINE = Path(__file__).with_name("baseline.json")
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ("pandas", "numpy", "pdfplumber", "pptx", "docx", "ffmpeg", "requests")
+
+SCALES = {
+    "small": {"sources": 2, "pairs": 50, "episodes": 500},
+    "medium": {"sources": 4, "pairs": 500, "episodes": 5000},
+    "large": {"sources": 8, "pairs": 5000, "episodes": 50000},
+}
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the feed of the server for any path"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(self.server.feed)))
+        self.end_headers()
+        self.wfile.write(self.server.feed)
+
+
+def serve_feed(episodes: int) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.feed = make_feed(episodes, base_url)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def best_of(repeat: int, setup, benchmark) -> float:
+    """The fastest of repeat runs of benchmark, each after setup"""
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        benchmark(state)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_pipeline_benchmarks(sources_json, work_dir: Path, args) -> dict:
+    from run import (
+        generate_audio,
+        generate_folder_structure,
+        generate_txt_files,
+        make_matching_maps,
+        map_and_standardize_filenames,
+    )
+    from source_handler.handler import SourceHandler
+
+    source_handler = SourceHandler(str(sources_json))
+    sources = source_handler.get_sources()
+    names = source_handler.get_source_names_ascii()
+    audio = partial(generate_audio, copy=True, wave=args.wave, jobs=args.jobs)
+    text = partial(generate_txt_files, jobs=args.jobs)
+
+    def output_folder(stages):
+        """A fresh output folder with stages already run"""
+        output = work_dir / "output"
+        shutil.rmtree(output, ignore_errors=True)
+        generate_folder_structure(names, output)
+        for stage in stages:
+            stage(sources, output)
+        return output
+
+    stages = [
+        ("make_matching_maps", make_matching_maps),
+        ("generate_audio", audio),
+        ("generate_txt_files", text),
+        ("standardize_files", map_and_standardize_filenames),
+    ]
+    results = {}
+    for i, (name, stage) in enumerate(stages):
+        done = [stage for _, stage in stages[:i]]
+        results[name] = best_of(
+            args.repeat,
+            partial(output_folder, done),
+            lambda output: stage(sources, output),
+        )
+    return results
+
+
+def run_rss_benchmark(episodes: int, args) -> float:
+    from rss_handler.rss_feed_reader import RSSFeedsHandler
+
+    server = serve_feed(episodes)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    feeds = {f"feed {i}": f"{url}/feed_{i}.xml" for i in range(4)}
+    try:
+        return best_of(
+            args.repeat,
+            lambda: RSSFeedsHandler(feeds, workers=4),
+            lambda handler: handler.get_total_length(),
+        )
+    finally:
+        server.shutdown()
+
+
+def run_import_benchmarks(args) -> dict:
+    def python(*arguments):
+        subprocess.run(
+            [sys.executable, *arguments],
+            cwd=REPOSITORY,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    return {
+        "import_run": best_of(
+            args.repeat, lambda: None, lambda _: python("-c", "import run")
+        ),
+        "run_help": best_of(
+            args.repeat, lambda: None, lambda _: python("run.py", "-h")
+        ),
+    }
+
+
+def eager_imports() -> list:
+    """The HEAVY_MODULES that importing run.py imports"""
+    check = (
+        "import sys, run; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", check],
+        cwd=REPOSITORY,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return output.split()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Prints the results next to the baseline, returns the regressions"""
+    regressions = []
+    print(f"{'benchmark':<24}{'seconds':>10}{'baseline':>10}{'ratio':>8}")
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base:
+            ratio = seconds / base
+            flag = ""
+            if ratio > 1 + tolerance:
+                flag = "  slower"
+                regressions.append(name)
+            print(f"{name:<24}{seconds:>10.3f}{base:>10.3f}{ratio:>8.2f}{flag}")
+        else:
+            print(f"{name:<24}{seconds:>10.3f}{'-':>10}{'-':>8}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the stages of run.py on a synthetic corpus"
+    )
+    parser.add_argument(
+        "--scale",
+        help="Size of the synthetic corpus. default=small",
+        choices=SCALES,
+        default="small",
+    )
+    parser.add_argument(
+        "--repeat", help="Runs of each benchmark. default=3", type=int, default=3
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Worker processes for the conversions. default=1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--wave",
+        help="Use this flag to benchmark converting 44.1 kHz stereo audio to wave, \
+            needs ffmpeg.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--baseline",
+        help=f"Path to the baseline file. default={BASELINE}",
+        default=BASELINE,
+    )
+    parser.add_argument(
+        "--save_baseline",
+        help="Use this flag to store the results as the baseline of the scale.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="How much slower than the baseline is a regression. default=0.2",
+        type=float,
+        default=0.2,
+    )
+    parser.add_argument(
+        "--work_dir",
+        help="Folder for the corpus and output, a temporary folder by default.",
+        default=None,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Use this flag to show the logging of the stages.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # The synthetic mapping files are missing files on purpose
+        logging.disable(logging.ERROR)
+
+    scale = SCALES[args.scale]
+    key = f"{args.scale}{'-wave' if args.wave else ''}-j{args.jobs}"
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="benchmarks-"))
+    try:
+        sources_json = make_corpus(
+            work_dir / "corpus",
+            scale["sources"],
+            scale["pairs"],
+            **({"sample_rate": 44100, "channels": 2} if args.wave else {}),
+        )
+        results = run_pipeline_benchmarks(sources_json, work_dir, args)
+        results["rss_feed_length"] = run_rss_benchmark(scale["episodes"], args)
+        results.update(run_import_benchmarks(args))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baselines = {}
+    if Path(args.baseline).exists():
+        with open(args.baseline, "r") as f:
+            baselines = json.load(f)
+
+    regressions = compare(results, baselines.get(key, {}), args.tolerance)
+    eager = eager_imports()
+    if eager:
+        print(f"Importing run.py also imports {eager}, they should be lazy")
+        regressions.append("eager_imports")
+
+    if args.save_baseline:
+        baselines[key] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+        print(f"Saved the baseline of {key} to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmarks are slower than the baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
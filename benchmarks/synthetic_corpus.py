@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+"""
+    This module builds a synthetic sources.json tree to run and benchmark
+    the pipeline on, at any scale.
+
+    Every source gets
+    audio/: wav files synthesized with numpy, a tone with some noise
+    text/: docx, pptx and pdf documents with random text, in turn
+    map.tsv: the mapping file, where a share of the rows (missing) points
+        to audio or text that was never written and a few files are not
+        mapped at all, like in real deliveries
+
+    and make_feed makes an rss feed of episodes for the rss handler.
+
+    Functionality:
+    run
+    python -m benchmarks.synthetic_corpus corpus_folder --sources 2 --pairs 100
+
+    which writes corpus_folder/sources.json, the input of run.py.
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import argparse
+import json
+import random
+import wave
+from pathlib import Path
+import numpy as np
+
+WORDS = (
+    "the audio and text of a source are matched by the mapping file so each "
+    "episode of the podcast gets a transcript that is aligned to the speech "
+    "data corpus training model sentence word recording speaker reykjavik"
+).split()
+
+TEXT_FORMATS = (".docx", ".pptx", ".pdf")
+
+
+def random_text(rng: random.Random, lines=20, words=12) -> list:
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(words // 2, words)))
+        for _ in range(lines)
+    ]
+
+
+def write_wav(path, seconds=2.0, sample_rate=16000, channels=1, seed=0) -> None:
+    """Writes a 16 bit wav of a tone with some noise"""
+    generator = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = 0.3 * np.sin(2 * np.pi * generator.uniform(100, 400) * t)
+    signal += generator.normal(0, 0.05, len(t))
+    samples = (np.clip(signal, -1, 1) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.repeat(samples, channels).tobytes())
+
+
+def write_docx(path, lines: list) -> None:
+    from docx import Document
+
+    document = Document()
+    for line in lines:
+        document.add_paragraph(line)
+    document.save(path)
+
+
+def write_pptx(path, lines: list, lines_per_slide=5) -> None:
+    from pptx import Presentation
+
+    presentation = Presentation()
+    for i in range(0, len(lines), lines_per_slide):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+        slide.shapes.title.text = lines[i]
+        slide.placeholders[1].text = "\n".join(lines[i + 1 : i + lines_per_slide])
+    presentation.save(path)
+
+
+def write_pdf(path, lines: list, lines_per_page=40) -> None:
+    """Writes a plain pdf with the lines in Helvetica, no library needed"""
+
+    def escape(line):
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    pages = [
+        lines[i : i + lines_per_page] for i in range(0, len(lines), lines_per_page)
+    ]
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (" ".join(f"{i} 0 R" for i in page_ids).encode(), len(pages)),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id, page in zip(page_ids, pages):
+        text = " ".join(f"({escape(line)}) '" for line in page)
+        content = f"BT /F1 11 Tf 50 800 Td 14 TL {text} ET".encode("latin-1")
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (page_id + 1)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    Path(path).write_bytes(pdf)
+
+
+WRITERS = {".docx": write_docx, ".pptx": write_pptx, ".pdf": write_pdf}
+
+
+def make_source(
+    folder,
+    pairs=100,
+    seconds=2.0,
+    sample_rate=16000,
+    channels=1,
+    missing=0.05,
+    lines=20,
+    seed=0,
+) -> tuple:
+    """
+    Writes the audio, text and map.tsv of one source into folder and
+    returns (audio_dir, text_dir, mapping_file).
+    """
+    rng = random.Random(seed)
+    folder = Path(folder)
+    audio_dir, text_dir = folder / "audio", folder / "text"
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    text_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = []
+    # A few files more than the rows, those are not in the mapping file
+    for i in range(pairs + max(1, pairs // 50)):
+        audio = f"episode_{i}.wav"
+        text = f"episode_{i}{TEXT_FORMATS[i % len(TEXT_FORMATS)]}"
+        if i < pairs:
+            rows.append((text, audio))
+        if i >= pairs or rng.random() >= missing:
+            write_wav(audio_dir / audio, seconds, sample_rate, channels, seed + i)
+        if i >= pairs or rng.random() >= missing:
+            WRITERS[Path(text).suffix](text_dir / text, random_text(rng, lines))
+
+    mapping_file = folder / "map.tsv"
+    with open(mapping_file, "w") as f:
+        f.write("text\taudio\n")
+        f.writelines(f"{text}\t{audio}\n" for text, audio in rows)
+    return audio_dir, text_dir, mapping_file
+
+
+def make_corpus(base, sources=2, pairs=100, **kwargs) -> Path:
+    """
+    Writes sources synthetic sources into base, see make_source for the
+    options, and returns the path of their sources.json.
+    """
+    base = Path(base)
+    entries = []
+    for i in range(sources):
+        name = f"Synthetic {i}"
+        audio_dir, text_dir, mapping_file = make_source(
+            base / f"source_{i}", pairs, seed=i * 1_000_003, **kwargs
+        )
+        entries.append(
+            {
+                "name": name,
+                "rss_feed": "",
+                "text_dir": str(text_dir),
+                "audio_dir": str(audio_dir),
+                "mapping_file": str(mapping_file),
+            }
+        )
+    sources_json = base / "sources.json"
+    with open(sources_json, "w") as f:
+        json.dump({"last_updated": "synthetic", "sources": entries}, f, indent=4)
+    return sources_json
+
+
+def make_feed(episodes: int, base_url: str, seed=0) -> bytes:
+    """An rss feed of episodes with enclosures and itunes:duration"""
+    rng = random.Random(seed)
+    items = "".join(
+        f"<item><title>Episode {i}</title>"
+        f"<guid>{base_url}/episode_{i}.mp3</guid>"
+        f"<enclosure url='{base_url}/episode_{i}.mp3' "
+        f"length='{rng.randint(10**6, 10**8)}' type='audio/mpeg'/>"
+        f"<itunes:duration>{rng.randint(60, 7200)}</itunes:duration></item>"
+        for i in range(episodes)
+    )
+    return (
+        "<?xml version='1.0' encoding='UTF-8'?>"
+        "<rss version='2.0' "
+        "xmlns:itunes='http://www.itunes.com/dtds/podcast-1.0.dtd'>"
+        f"<channel><title>Synthetic</title>{items}</channel></rss>"
+    ).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds a synthetic sources.json tree for run.py"
+    )
+    parser.add_argument("folder", help="Path to the folder to write the corpus to.")
+    parser.add_argument(
+        "--sources", help="Number of sources. default=2", type=int, default=2
+    )
+    parser.add_argument(
+        "--pairs", help="Rows per mapping file. default=100", type=int, default=100
+    )
+    parser.add_argument(
+        "--seconds", help="Seconds of each audio file. default=2", type=float, default=2
+    )
+    parser.add_argument(
+        "--sample_rate",
+        help="Sample rate of the audio, 16000 needs no conversion. default=16000",
+        type=int,
+        default=16000,
+    )
+    parser.add_argument(
+        "--missing",
+        help="Share of rows missing their audio or text. default=0.05",
+        type=float,
+        default=0.05,
+    )
+    args = parser.parse_args()
+
+    sources_json = make_corpus(
+        args.folder,
+        args.sources,
+        args.pairs,
+        seconds=args.seconds,
+        sample_rate=args.sample_rate,
+        missing=args.missing,
+    )
+    print(f"Wrote {sources_json}")
+
+
+if __name__ == "__main__":
+    main()
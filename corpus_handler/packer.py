@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+    This module packs the standardized output of a source into tar shards
+    for training, in the layout of WebDataset: the audio and text of a
+    sample are stored next to each other under their standardized basename,
+
+    source_name_000001.wav
+    source_name_000001.txt
+    source_name_000002.wav
+    ...
+
+    in the order of mapping.tsv. A shard is closed when the next sample
+    would make it larger than shard_size, so shards are read sequentially
+    with large reads instead of one small read per file. The shards are
+    uncompressed and written to the shards folder of the source together
+    with index.tsv, which has one row per member:
+
+    key: the basename of the sample, e.g. source_name_000001
+    shard: the file name of the shard
+    member: the name of the member in the shard
+    offset: where the data of the member starts in the shard
+    size: the size of the data of the member
+
+    so a reader can seek to any sample directly without tarfile.
+
+    Example:
+
+    index = pack_source(Path(destination, source_name))
+    row = index[index.member == "source_name_000001.txt"].iloc[0]
+    with open(Path(destination, source_name, "shards", row.shard), "rb") as f:
+        f.seek(row.offset)
+        text = f.read(row.size).decode("utf-8")
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import logging
+import os
+import tarfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SHARDS_FOLDER = "shards"
+INDEX_FILENAME = "index.tsv"
+
+
+def __samples(folder: Path, mapping: "pd.DataFrame") -> list:
+    """Returns [(key, [(member, path)])] for the samples whose files exist"""
+    samples = []
+    for audio, text in zip(mapping.audio, mapping.text):
+        audio_path = folder / "audio" / audio
+        text_path = folder / "text" / text
+        missing = [path for path in (audio_path, text_path) if not path.exists()]
+        if missing:
+            logging.error(f"Cannot find {missing}, not packing {audio} and {text}")
+            continue
+        key = Path(audio).stem
+        samples.append(
+            (
+                key,
+                [
+                    (f"{key}{audio_path.suffix}", audio_path),
+                    (f"{key}.txt", text_path),
+                ],
+            )
+        )
+    return samples
+
+
+def __add(tar: tarfile.TarFile, member: str, path: Path) -> tuple:
+    """Adds path as member and returns the (offset, size) of its data"""
+    # Open the file so symlinked audio is stored by content
+    with open(path, "rb") as f:
+        info = tarfile.TarInfo(member)
+        info.size = os.fstat(f.fileno()).st_size
+        info.mtime = int(os.fstat(f.fileno()).st_mtime)
+        info.mode = 0o644
+        offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+        tar.addfile(info, f)
+    return offset, info.size
+
+
+def pack_source(folder, shard_size=1024**3) -> "pd.DataFrame":
+    """
+    Packs the files in mapping.tsv of the source in folder into tar shards
+    of about shard_size bytes (a larger sample gets a shard of its own)
+    and returns the index, which is also written to shards/index.tsv.
+    """
+    import pandas as pd
+
+    folder = Path(folder)
+    mapping = pd.read_csv(folder / "mapping.tsv", sep="\t")
+    shards_folder = folder / SHARDS_FOLDER
+    shards_folder.mkdir(exist_ok=True)
+
+    rows = []
+    shards = []
+    tar = None
+    for key, members in __samples(folder, mapping):
+        sample_size = sum(
+            tarfile.BLOCKSIZE * (2 + (path.stat().st_size - 1) // tarfile.BLOCKSIZE)
+            for _, path in members
+        )
+        if tar is None or (tar.offset and tar.offset + sample_size > shard_size):
+            if tar is not None:
+                tar.close()
+            shards.append(f"{folder.name}-{len(shards):06d}.tar")
+            tar = tarfile.open(
+                shards_folder / f"{shards[-1]}.tmp", "w", format=tarfile.GNU_FORMAT
+            )
+        for member, path in members:
+            offset, size = __add(tar, member, path)
+            rows.append((key, shards[-1], member, offset, size))
+    if tar is not None:
+        tar.close()
+
+    for shard in shards:
+        os.replace(shards_folder / f"{shard}.tmp", shards_folder / shard)
+    # Shards of an earlier, larger pack
+    for old_shard in shards_folder.glob(f"{folder.name}-*.tar"):
+        if old_shard.name not in shards:
+            old_shard.unlink()
+
+    index = pd.DataFrame(rows, columns=["key", "shard", "member", "offset", "size"])
+    tmp_path = shards_folder / f"{INDEX_FILENAME}.tmp"
+    index.to_csv(tmp_path, sep="\t", index=False)
+    os.replace(tmp_path, shards_folder / INDEX_FILENAME)
+    return index
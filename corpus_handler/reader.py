@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the CorpusReader class, random access to the
+    samples of an output folder made by run.py with -wave.
+
+    The first time a folder is read the mapping.tsv of every source is
+    parsed and the header of every wav file is read once to build a compact
+    index of numpy arrays (the key, audio and text path, and the offset and
+    number of samples of the PCM data of each sample). The index is stored
+    as corpus_index.npz in the folder and built again only when a mapping.tsv
+    changes.
+
+    A sample is then found in O(1) and its audio is a read-only numpy
+    memmap of the 16 bit PCM data in the wav file, so nothing is read or
+    copied until the audio is used. Only 16 kHz mono 16 bit PCM wav files,
+    as made by copy_and_convert_to_wav, are indexed.
+
+    Example:
+
+    corpus = CorpusReader("output")  # or "output/source_name"
+    sample = corpus[123]
+    sample.key    # source_name_000124
+    sample.audio  # np.memmap of int16, 16000 per second
+    sample.text   # the text of the sample
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from collections import namedtuple
+import logging
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from utilities.audio_headers import FileReader, wav_info
+
+SAMPLE_RATE = 16000
+# format_tag, channels, sample_rate and bits of 16 kHz 16 bit mono PCM
+PCM = (1, 1, SAMPLE_RATE, 16)
+
+Sample = namedtuple("Sample", ["key", "audio", "text"])
+
+
+class CorpusReader:
+    INDEX_FILENAME = "corpus_index.npz"
+    # Bump when the index changes, older indexes are then rebuilt
+    INDEX_VERSION = 2
+
+    def __init__(self, folder, rebuild=False) -> None:
+        """
+        folder is the output folder of run.py or the folder of one source.
+        With rebuild the stored index is ignored.
+        """
+        self.folder = Path(folder)
+        self.index_path = self.folder / self.INDEX_FILENAME
+
+        if (self.folder / "mapping.tsv").exists():
+            mappings = [self.folder / "mapping.tsv"]
+        else:
+            mappings = sorted(self.folder.glob("*/mapping.tsv"))
+        self.mappings = np.array(
+            [str(path.relative_to(self.folder)) for path in mappings], dtype=str
+        )
+        self.mapping_mtimes = np.array(
+            [path.stat().st_mtime_ns for path in mappings], dtype=np.int64
+        )
+
+        if rebuild or not self.__load():
+            self.__build()
+            self.__save()
+
+    def __load(self) -> bool:
+        """Loads the stored index if it was built from the current mappings"""
+        try:
+            with np.load(self.index_path, allow_pickle=False) as index:
+                if not (
+                    index["version"] == self.INDEX_VERSION
+                    and np.array_equal(index["mappings"], self.mappings)
+                    and np.array_equal(index["mapping_mtimes"], self.mapping_mtimes)
+                ):
+                    return False
+                self.keys = index["keys"]
+                self.audio_paths = index["audio_paths"]
+                self.text_paths = index["text_paths"]
+                self.offsets = index["offsets"]
+                self.lengths = index["lengths"]
+        except (IOError, KeyError, ValueError):
+            return False
+        return True
+
+    def __build(self) -> None:
+        keys, audio_paths, text_paths, offsets, lengths = [], [], [], [], []
+        for mapping_path in self.mappings:
+            source_folder = Path(mapping_path).parent
+            mapping = pd.read_csv(self.folder / mapping_path, sep="\t")
+            for audio, text in zip(mapping.audio, mapping.text):
+                audio_path = source_folder / "audio" / audio
+                try:
+                    with FileReader(self.folder / audio_path) as reader:
+                        info = wav_info(reader)
+                except IOError as e:
+                    logging.error(f"Cannot read {audio_path}, not indexing it: {e}")
+                    continue
+                audio_format = info and (
+                    info.format_tag,
+                    info.channels,
+                    info.sample_rate,
+                    info.bits,
+                )
+                if audio_format != PCM:
+                    logging.warning(
+                        f"{audio_path} is not 16 kHz 16 bit mono PCM, skipping"
+                    )
+                    continue
+                keys.append(Path(audio).stem)
+                audio_paths.append(str(audio_path))
+                text_paths.append(str(source_folder / "text" / text))
+                offsets.append(info.data_offset)
+                lengths.append(info.data_size // 2)
+
+        self.keys = np.array(keys, dtype=str)
+        self.audio_paths = np.array(audio_paths, dtype=str)
+        self.text_paths = np.array(text_paths, dtype=str)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+
+    def __save(self) -> None:
+        # np.savez adds .npz to names without it
+        tmp_path = self.index_path.with_name(f"{self.index_path.stem}.tmp.npz")
+        np.savez(
+            tmp_path,
+            version=self.INDEX_VERSION,
+            mappings=self.mappings,
+            mapping_mtimes=self.mapping_mtimes,
+            keys=self.keys,
+            audio_paths=self.audio_paths,
+            text_paths=self.text_paths,
+            offsets=self.offsets,
+            lengths=self.lengths,
+        )
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def audio(self, i: int) -> np.ndarray:
+        """The samples of i as a read-only memmap of int16"""
+        if not self.lengths[i]:
+            return np.zeros(0, dtype="<i2")
+        return np.memmap(
+            self.folder / self.audio_paths[i],
+            dtype="<i2",
+            mode="r",
+            offset=int(self.offsets[i]),
+            shape=(int(self.lengths[i]),),
+        )
+
+    def text(self, i: int) -> str:
+        with open(self.folder / self.text_paths[i], "r", encoding="utf-8") as f:
+            return f.read()
+
+    def duration(self, i: int) -> float:
+        return self.lengths[i] / SAMPLE_RATE
+
+    def __getitem__(self, i: int) -> Sample:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Sample {i} is out of range")
+        return Sample(str(self.keys[i]), self.audio(i), self.text(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
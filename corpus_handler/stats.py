@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+    This module reports how much audio an output folder of run.py holds.
+
+    The mapping.tsv of every source is walked and the duration of each
+    audio file is read from its header (wav, mp3 or mp4), without decoding,
+    on a pool of threads. Durations are cached in durations.json in the
+    folder of each source by the size and modification time of the file,
+    so a re-run only reads the headers of new or changed files.
+
+    Functionality:
+    run
+    python -m corpus_handler.stats output_folder -j 32
+
+    which prints the hours, the number of audio/text pairs and the missing
+    files of each source and in total.
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+import pandas as pd
+from tqdm import tqdm
+
+from utilities.audio_headers import FileReader, audio_duration
+from utilities.utilities import seconds_to_hours_mins
+
+CACHE_FILENAME = "durations.json"
+CHUNK_SIZE = 1000
+
+
+def __scan_file(audio_path: Path, text_path: Path, cached) -> tuple:
+    """
+    Returns (size, mtime, duration, text_exists) of a pair, size is None if
+    the audio is missing and duration None if it could not be read.
+    """
+    text_exists = text_path.exists()
+    try:
+        stat = os.stat(audio_path)
+    except FileNotFoundError:
+        return None, None, None, text_exists
+    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return stat.st_size, stat.st_mtime_ns, cached[2], text_exists
+    try:
+        with FileReader(audio_path) as reader:
+            duration = audio_duration(reader)
+    except IOError:
+        duration = None
+    return stat.st_size, stat.st_mtime_ns, duration, text_exists
+
+
+def __scan_chunk(chunk: list) -> list:
+    return [__scan_file(*pair) for pair in chunk]
+
+
+def scan_source(folder, executor: ThreadPoolExecutor) -> dict:
+    """Returns the stats of the source in folder, using its duration cache"""
+    folder = Path(folder)
+    cache_path = folder / CACHE_FILENAME
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    mapping = pd.read_csv(folder / "mapping.tsv", sep="\t")
+    pairs = [
+        (folder / "audio" / audio, folder / "text" / text, cache.get(audio))
+        for audio, text in zip(mapping.audio, mapping.text)
+    ]
+    chunks = (pairs[i : i + CHUNK_SIZE] for i in range(0, len(pairs), CHUNK_SIZE))
+
+    stats = {
+        "pairs": len(pairs),
+        "seconds": 0.0,
+        "missing_audio": 0,
+        "missing_text": 0,
+        "unknown_duration": 0,
+    }
+    new_cache = {}
+    progress = tqdm(total=len(pairs), desc=f"Scanning {folder.name}")
+    for start, results in zip(
+        range(0, len(pairs), CHUNK_SIZE), executor.map(__scan_chunk, chunks)
+    ):
+        names = mapping.audio[start : start + CHUNK_SIZE]
+        for name, (size, mtime, duration, text_exists) in zip(names, results):
+            stats["missing_text"] += not text_exists
+            if size is None:
+                stats["missing_audio"] += 1
+                continue
+            if duration is None:
+                stats["unknown_duration"] += 1
+            else:
+                stats["seconds"] += duration
+            new_cache[name] = [size, mtime, duration]
+        progress.update(len(results))
+    progress.close()
+
+    if new_cache != cache:
+        tmp_path = cache_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(new_cache, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    return stats
+
+
+def __print_stats(name: str, stats: dict) -> None:
+    hours, mins = seconds_to_hours_mins(stats["seconds"])
+    print(
+        f"{name}: {hours} hours and {mins} minutes, {stats['pairs']} pairs, "
+        f"{stats['missing_audio']} missing audio, "
+        f"{stats['missing_text']} missing text, "
+        f"{stats['unknown_duration']} of unknown duration"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports the hours and files of an output folder of run.py"
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        help="Number of threads reading headers. default=16",
+        type=int,
+        default=16,
+    )
+
+    parser.add_argument("output_folder", help="Path to the output folder.")
+
+    args = parser.parse_args()
+
+    folders = sorted(
+        path.parent for path in Path(args.output_folder).glob("*/mapping.tsv")
+    )
+    if not folders:
+        logging.error(f"Cannot find any mapping.tsv in {args.output_folder}")
+        return
+
+    total = {}
+    with ThreadPoolExecutor(args.jobs) as executor:
+        for folder in folders:
+            stats = scan_source(folder, executor)
+            __print_stats(folder.name, stats)
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + value
+    __print_stats("Total", total)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,12 @@
     reader.read(input_filepath)
     reader.save(output_filepath) # -> saves as plain text
 
+    reader.stream_to_txt(input_filepath, output_filepath)
+    # -> the same, but written page by page without keeping the whole text
+
+    convert_document(input_filepath, output_filepath)
+    # -> stream_to_txt with a reader of its own, safe to use from worker processes
+
     TODO: Clean .pdf output from itemized and numbered list symbols.
 
 """
@@ -19,55 +25,119 @@ ___author___ = "Staffan Hedström"
 ___license___ = "Apache 2.0"
 ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
-from pptx import Presentation
-import pdfplumber
-from docx import Document
+from functools import lru_cache
+import logging
+import os
+import shutil
+import subprocess
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
+
+from document_handler.extractors import (
+    DocxExtractor,
+    PdfplumberExtractor,
+    PptxExtractor,
+    get_extractor,
+)
+from document_handler.text_cache import TextCache
+
+# Bump when a change to the extraction changes the text it outputs
+EXTRACTOR_VERSION = "1"
+
+
+def __package_version(name) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return ""
+
+
+def __pdftotext_version() -> str:
+    if not shutil.which("pdftotext"):
+        return ""
+    try:
+        # e.g. "pdftotext version 22.02.0" on the first line of stderr
+        output = subprocess.run(
+            ["pdftotext", "-v"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        ).stdout
+    except OSError:
+        return ""
+    return output.split("\n")[0].split()[-1] if output.strip() else ""
+
+
+@lru_cache(maxsize=None)
+def extractor_version() -> str:
+    """
+    Identifies the extraction code and the versions of the parsers, read
+    from the package metadata so the parsers do not have to be imported,
+    and of the pdftotext tool if it is installed.
+    """
+    return (
+        f"{EXTRACTOR_VERSION}"
+        f"-pdfplumber{__package_version('pdfplumber')}"
+        f"-pdfminer{__package_version('pdfminer.six')}"
+        f"-pdftotext{__pdftotext_version()}"
+        f"-pptx{__package_version('python-pptx')}"
+        f"-docx{__package_version('python-docx')}"
+    )
 
 
 class DocumentReader:
-    def __init__(self) -> None:
+    def __init__(self, mode="fidelity") -> None:
+        """
+        mode chooses between extractors, "fidelity" keeps the page layout and
+        "speed" reads pdfs much faster, see document_handler.extractors.
+        """
         self.text = []
+        self.mode = mode
+
+    def iter_presentation(self, filepath):
+        """Yields the text of a presentation run by run, slide by slide"""
+        return PptxExtractor().iter_text(filepath)
+
+    def iter_pdf(self, filepath):
+        """Yields the text of a pdf page by page"""
+        return PdfplumberExtractor().iter_text(filepath)
+
+    def iter_docx(self, filepath):
+        """Yields the text of a docx paragraph by paragraph"""
+        return DocxExtractor().iter_text(filepath)
+
+    def extractor_for(self, filepath):
+        """The extractor for the document in the mode of the reader or None"""
+        return get_extractor(filepath, self.mode)
+
+    def iter_text(self, filepath):
+        """Yields the text of a document chunk by chunk, None if unknown"""
+        extractor = self.extractor_for(filepath)
+        return extractor.iter_text(filepath) if extractor else None
 
     def text_from_presentation(self, filepath) -> list:
-        prs = Presentation(filepath)
-
-        text = []
-
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if not shape.has_text_frame:
-                    continue
-                for paragraph in shape.text_frame.paragraphs:
-                    for run in paragraph.runs:
-                        # Only add strings with text
-                        if run.text:
-                            text.append(run.text)
-        self.text = text
-        return text
+        self.text = list(self.iter_presentation(filepath))
+        return self.text
 
     def text_from_pdf(self, filepath) -> list:
-        text = []
-        pdf = pdfplumber.open(filepath)
-        for page in pdf.pages:
-            text.append(page.extract_text())
-        self.text = text
-        return text
+        self.text = list(self.iter_pdf(filepath))
+        return self.text
 
     def text_from_docx(self, filepath) -> list:
-        text = []
-        docx = Document(filepath)
-        for p in docx.paragraphs:
-            text.append(" ".join(p.text.split()))  # fixes a few whitespace issues
-        return text
+        self.text = list(self.iter_docx(filepath))
+        return self.text
 
     def read(self, filepath) -> list:
-        if ".pptx" in filepath:
-            return self.text_from_presentation(filepath)
-        if ".pdf" in filepath:
-            return self.text_from_pdf(filepath)
-        if ".docx" in filepath or ".doc" in filepath:
-            return self.text_from_docx(filepath)
-        return "Unknown format. Known formats are ['.pdf','.pptx', '.docx', '.doc']"
+        # Never let the text of a previous document leak into this one
+        self.text = []
+        chunks = self.iter_text(filepath)
+        if chunks is None:
+            return "Unknown format. Known formats are ['.pdf','.pptx', '.docx', '.doc']"
+        self.text = list(chunks)
+        return self.text
 
     def save(self, output_path) -> bool:
         # Clean output_path
@@ -78,12 +148,39 @@ class DocumentReader:
                 f.writelines(self.text)
             return True
         except IOError:
-            print(
-                "An error occurred while creating or writing to the file: \
+            logging.error(
+                f"An error occurred while creating or writing to the file: \
                     {output_txt}"
             )
             return False
 
+    def stream_to_txt(self, input_path, output_path):
+        """
+        Extracts the text of the document at input_path chunk by chunk (page,
+        slide or paragraph) and writes each chunk straight to the .txt
+        version of output_path, so memory stays flat however long the
+        document is. The output is the same as read() followed by save().
+
+        Returns the path of the .txt file or None if the format is unknown.
+        """
+        chunks = self.iter_text(input_path)
+        if chunks is None:
+            logging.warning(f"Unknown format of '{input_path}', skipping it")
+            return None
+
+        output_txt = self.to_txt_path(output_path)
+        # Written next to the output and moved into place when complete
+        tmp_txt = f"{output_txt}.tmp"
+        try:
+            with open(tmp_txt, "w") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_txt, output_txt)
+        finally:
+            if os.path.exists(tmp_txt):
+                os.remove(tmp_txt)
+        return output_txt
+
     def to_txt_path(self, path):
         """Makes a path end with .txt"""
         output = path.split(".")
@@ -91,6 +188,37 @@ class DocumentReader:
         return ".".join(output)
 
 
+def convert_document(input_path, output_path, text_cache_folder=None, mode="fidelity"):
+    """
+    Streams the text of the document at input_path to a .txt at output_path,
+    see DocumentReader.stream_to_txt. mode is the mode of the reader.
+
+    With a text_cache_folder the text is taken from the TextCache there if
+    the same document has been converted before by the same extractor, and
+    stored in it otherwise.
+
+    Every call uses a reader of its own so it can safely be run in parallel,
+    e.g. from the worker processes of utilities.run_in_pool.
+
+    Returns the path of the saved .txt file or None if it could not be saved.
+    """
+    reader = DocumentReader(mode)
+    extractor = reader.extractor_for(input_path)
+    if not text_cache_folder or not extractor:
+        return reader.stream_to_txt(input_path, output_path)
+
+    cache = TextCache(text_cache_folder, f"{extractor_version()}-{extractor.name}")
+    cached = cache.lookup(input_path)
+    output_txt = reader.to_txt_path(output_path)
+    if cache.get(cached, output_txt):
+        return output_txt
+
+    output_txt = reader.stream_to_txt(input_path, output_path)
+    if output_txt:
+        cache.put(cached, output_txt)
+    return output_txt
+
+
 def main():
     file = "document_handler/test_inputs/test_pdf.pdf"
     reader = DocumentReader()
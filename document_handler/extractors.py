@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the text extractors used by the DocumentReader and
+    the registry that picks one for a document.
+
+    The format of a document is detected from its magic bytes, falling back
+    to its suffix, so e.g. report.pdf.docx is read as a docx. Every
+    extractor declares the formats it reads and its capabilities:
+
+    "layout": keeps the reading order of the page layout, slower
+    "fast": plain text in content order, much faster on long pdfs
+
+    Which one is used depends on the mode, "fidelity" (default) prefers
+    layout capable extractors and "speed" prefers fast ones. Extractors that
+    are not available, e.g. pdftotext when poppler is not installed, are
+    skipped. The parser libraries are only imported when a document of
+    their format is read.
+
+    Example:
+
+    extractor = get_extractor("document.pdf", mode="speed")
+    for chunk in extractor.iter_text("document.pdf"):
+        ...
+
+    New extractors are added with register(MyExtractor()).
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from pathlib import Path
+import io
+import shutil
+import subprocess
+import zipfile
+
+MODES = {"fidelity": "layout", "speed": "fast"}
+
+
+class Extractor:
+    name = ""
+    formats = ()
+    capabilities = set()
+
+    def available(self) -> bool:
+        return True
+
+    def iter_text(self, filepath):
+        """Yields the text of the document chunk by chunk"""
+        raise NotImplementedError
+
+
+class PptxExtractor(Extractor):
+    name = "python-pptx"
+    formats = (".pptx",)
+    capabilities = {"layout"}
+
+    def iter_text(self, filepath):
+        """Yields the text of a presentation run by run, slide by slide"""
+        from pptx import Presentation
+
+        prs = Presentation(filepath)
+
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if not shape.has_text_frame:
+                    continue
+                for paragraph in shape.text_frame.paragraphs:
+                    for run in paragraph.runs:
+                        # Only add strings with text
+                        if run.text:
+                            yield run.text
+
+
+class DocxExtractor(Extractor):
+    name = "python-docx"
+    formats = (".docx", ".doc")
+    capabilities = {"layout"}
+
+    def iter_text(self, filepath):
+        """Yields the text of a docx paragraph by paragraph"""
+        from docx import Document
+
+        docx = Document(filepath)
+        for p in docx.paragraphs:
+            yield " ".join(p.text.split())  # fixes a few whitespace issues
+
+
+class PdfplumberExtractor(Extractor):
+    name = "pdfplumber"
+    formats = (".pdf",)
+    capabilities = {"layout"}
+
+    def iter_text(self, filepath):
+        """
+        Yields the text of a pdf page by page. The layout cached for a page
+        is released as soon as its text has been extracted.
+        """
+        import pdfplumber
+
+        with pdfplumber.open(filepath) as pdf:
+            for page in pdf.pages:
+                text = page.extract_text()
+                release = getattr(page, "close", None) or getattr(
+                    page, "flush_cache", None
+                )
+                if release:
+                    release()
+                # Blank pages have no text
+                yield text or ""
+
+
+class PdfminerExtractor(Extractor):
+    """
+    pdfminer, which pdfplumber is built on. Characters are only grouped into
+    lines, the slower ordering of text boxes (boxes_flow) is left out.
+    """
+
+    name = "pdfminer"
+    formats = (".pdf",)
+    capabilities = {"fast"}
+
+    def iter_text(self, filepath):
+        from pdfminer.converter import TextConverter
+        from pdfminer.layout import LAParams
+        from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+        from pdfminer.pdfpage import PDFPage
+
+        resources = PDFResourceManager()
+        text = io.StringIO()
+        device = TextConverter(resources, text, laparams=LAParams(boxes_flow=None))
+        interpreter = PDFPageInterpreter(resources, device)
+        try:
+            with open(filepath, "rb") as f:
+                for page in PDFPage.get_pages(f):
+                    interpreter.process_page(page)
+                    yield text.getvalue()
+                    text.seek(0)
+                    text.truncate()
+        finally:
+            device.close()
+
+
+class PdftotextExtractor(Extractor):
+    """The pdftotext command line tool of poppler, if it is installed"""
+
+    name = "pdftotext"
+    formats = (".pdf",)
+    capabilities = {"fast"}
+
+    def available(self) -> bool:
+        return shutil.which("pdftotext") is not None
+
+    def iter_text(self, filepath):
+        process = subprocess.Popen(
+            ["pdftotext", "-q", "-enc", "UTF-8", str(filepath), "-"],
+            stdout=subprocess.PIPE,
+        )
+        with process:
+            reader = io.TextIOWrapper(process.stdout, encoding="utf-8")
+            for chunk in iter(lambda: reader.read(64 * 1024), ""):
+                yield chunk
+        if process.returncode:
+            raise IOError(f"pdftotext failed on '{filepath}'")
+
+
+# In order of preference within each capability
+EXTRACTORS = []
+
+
+def register(extractor: Extractor) -> None:
+    EXTRACTORS.append(extractor)
+
+
+for extractor in (
+    PdfplumberExtractor(),
+    PdftotextExtractor(),
+    PdfminerExtractor(),
+    PptxExtractor(),
+    DocxExtractor(),
+):
+    register(extractor)
+
+
+def detect_format(filepath) -> str:
+    """
+    Returns the format of a document as a suffix, e.g. ".pdf", from its
+    magic bytes or else from its suffix.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            magic = f.read(8)
+    except IOError:
+        magic = b""
+
+    if magic.startswith(b"%PDF"):
+        return ".pdf"
+    if magic.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(filepath) as archive:
+                names = archive.namelist()
+            if any(name.startswith("word/") for name in names):
+                return ".docx"
+            if any(name.startswith("ppt/") for name in names):
+                return ".pptx"
+        except zipfile.BadZipFile:
+            pass
+    return Path(filepath).suffix.lower()
+
+
+def get_extractor(filepath, mode="fidelity"):
+    """
+    Returns the extractor to use for the document at filepath in mode, or
+    None if no available extractor reads its format.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode '{mode}', known modes are {list(MODES)}")
+
+    document_format = detect_format(filepath)
+    candidates = [
+        extractor
+        for extractor in EXTRACTORS
+        if document_format in extractor.formats and extractor.available()
+    ]
+    # Extractors with the capability of the mode first, the rest as fallback
+    candidates.sort(key=lambda extractor: MODES[mode] not in extractor.capabilities)
+    return candidates[0] if candidates else None
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the TextCache class, a content addressed cache of
+    the text extracted from documents.
+
+    The same document is often delivered to several sources or again under a
+    new name. The cache keys the extracted text by the hash of the document
+    and the version of the extractors, so a document is only parsed once and
+    a new extractor version never serves stale text. The cache lives in
+    ~/.cache/speech-corpus-tools/text unless told otherwise, and is kept
+    below max_bytes by removing the least recently used texts.
+
+    Example:
+
+    cache = TextCache()
+    cached = cache.lookup(document_path)
+    if not cache.get(cached, output_txt):
+        ...  # extract the text to output_txt
+        cache.put(cached, output_txt)
+    cache.evict()
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+from utilities.manifest import file_hash
+from utilities.utilities import cache_folder, evict_least_recently_used
+
+
+class TextCache:
+    def __init__(self, folder=None, version="", max_bytes=2 * 1024**3) -> None:
+        """
+        version identifies the extractors, texts cached with another version
+        are never returned.
+        """
+        self.folder = Path(folder) if folder else cache_folder("text")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.max_bytes = max_bytes
+
+    def lookup(self, document_path) -> Path:
+        """The path in the cache for the text of the document"""
+        key = hashlib.sha1(
+            f"{file_hash(document_path)}:{self.version}".encode("utf-8")
+        ).hexdigest()
+        return self.folder / f"{key}.txt"
+
+    def __copy(self, source, destination) -> None:
+        tmp_path = f"{destination}.{os.getpid()}.tmp"
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+
+    def get(self, cached: Path, output_txt) -> bool:
+        """Copies the cached text to output_txt if it is in the cache"""
+        try:
+            self.__copy(cached, output_txt)
+        except FileNotFoundError:
+            return False
+        os.utime(cached)  # mark as recently used
+        return True
+
+    def put(self, cached: Path, txt_path) -> None:
+        """Stores txt_path in the cache as cached"""
+        self.__copy(txt_path, cached)
+
+    def evict(self) -> int:
+        """Removes least recently used texts until the cache fits max_bytes"""
+        return evict_least_recently_used(self.folder, self.max_bytes)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the EpisodeDownloader class which downloads the
+    audio of rss feeds into the audio dir of each source.
+
+    Every episode is downloaded to a .part file which is renamed into place
+    once it is complete, so the audio dir never contains half written files.
+    An interrupted download is resumed from where it stopped with an HTTP
+    Range request, and episodes that are already complete are skipped.
+
+    Episodes are named after the file name of their url. When several
+    episodes of a feed share one, e.g. .../<id>/audio.mp3, each of them gets
+    a short hash of its url added, see unique_filenames.
+
+    Example:
+
+    downloader = EpisodeDownloader(workers=8, per_host=2, max_rate=10_000_000)
+    downloader.download_sources(source_handler.get_sources())
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from rss_handler.feed_parser import iter_episodes
+from rss_handler.session import HostLimits, make_session
+from tqdm import tqdm
+
+
+class RateLimiter:
+    """Limits the bytes per second shared by all threads, None is unlimited"""
+
+    def __init__(self, bytes_per_second=None) -> None:
+        self.rate = bytes_per_second
+        self.__next_slot = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            start = max(self.__next_slot, now)
+            self.__next_slot = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def episode_filename(url: str) -> str:
+    """The file name of an episode, taken from the path of its url"""
+    name = unquote(Path(urlsplit(url).path).name)
+    return name or hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def unique_filenames(urls: list) -> dict:
+    """
+    Returns a {url: file name} dict, names that more than one url would get
+    have the start of the sha1 of the url added, e.g. audio_1a2b3c4d.mp3
+    """
+    names = {url: episode_filename(url) for url in urls}
+    counts = Counter(names.values())
+    for url, name in names.items():
+        if counts[name] > 1:
+            path = Path(name)
+            digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+            names[url] = f"{path.stem}_{digest}{path.suffix}"
+    return names
+
+
+class EpisodeDownloader:
+    def __init__(
+        self,
+        workers=4,
+        per_host=2,
+        max_rate=None,
+        timeout=60,
+        retries=3,
+        chunk_size=64 * 1024,
+        session=None,
+    ) -> None:
+        """
+        workers: number of downloads running at a time
+        per_host: number of downloads from the same host at a time
+        max_rate: limit of the total download speed in bytes per second
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.session = session or make_session(max(workers, 10), retries)
+        self.host_limits = HostLimits(per_host)
+        self.rate_limiter = RateLimiter(max_rate)
+
+    def __is_complete(self, path: Path, url: str, expected_length) -> bool:
+        if not path.exists():
+            return False
+        size = path.stat().st_size
+        if expected_length is None or size == expected_length:
+            return True
+        # The declared length of feeds is often off, ask the server
+        r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        return r.ok and size == int(r.headers.get("content-length", -1))
+
+    def download(self, url: str, folder, expected_length=None, filename=None) -> tuple:
+        """
+        Downloads url into folder, as filename or episode_filename(url), and
+        returns the path of the file and the number of bytes downloaded. Does
+        nothing if the file is already complete.
+        """
+        path = Path(folder, filename or episode_filename(url))
+        if self.__is_complete(path, url, expected_length):
+            return path, 0
+
+        part_path = path.with_name(f"{path.name}.part")
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.host_limits.limit(url):
+            r = self.session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            )
+            with r:
+                if r.status_code == 416 and offset:
+                    # Nothing left to download
+                    os.replace(part_path, path)
+                    return path, 0
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset = 0  # The server ignored the range, start over
+
+                size = 0
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(self.chunk_size):
+                        self.rate_limiter.consume(len(chunk))
+                        f.write(chunk)
+                        size += len(chunk)
+
+        os.replace(part_path, path)
+        return path, size
+
+    def download_feed(self, feed_url: str, folder, executor) -> list:
+        """Queues the download of every episode of the feed on executor"""
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        with self.session.get(feed_url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            # An episode listed twice is downloaded once
+            episodes = {episode.url: episode for episode in iter_episodes(r.raw)}
+        filenames = unique_filenames(list(episodes))
+        return [
+            (
+                url,
+                executor.submit(
+                    self.download, url, folder, episode.length, filenames[url]
+                ),
+            )
+            for url, episode in episodes.items()
+        ]
+
+    def download_sources(self, sources: list) -> list:
+        """
+        Downloads the episodes of every source with an rss feed into its
+        audio dir, all sources at the same time.
+
+        Returns the urls that could not be downloaded and (url, path, bytes)
+        of every file that was downloaded, complete files are left out.
+        """
+        failed = []
+        downloaded = []
+        downloads = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            for source in sources:
+                if not source.rss_feed_url:
+                    continue
+                try:
+                    downloads += self.download_feed(
+                        source.rss_feed_url, source.audio_path, executor
+                    )
+                except Exception as e:
+                    logging.error(f"Cannot read the feed of {source.name}: {e!r}")
+
+            for url, download in tqdm(downloads, "Downloading episodes"):
+                try:
+                    path, size = download.result()
+                except Exception as e:
+                    logging.error(f"Cannot download {url}: {e!r}")
+                    failed.append(url)
+                    continue
+                if size:
+                    downloaded.append((url, path, size))
+        return failed, downloaded
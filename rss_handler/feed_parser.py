@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+    This module parses rss feeds as a stream. Items are yielded as soon as
+    they have been read and are then dropped from the tree, so memory stays
+    flat no matter how many episodes a feed has.
+
+    Example:
+
+    with open("feed.xml", "rb") as f:
+        for episode in iter_episodes(f):
+            print(episode.url, episode.length, episode.duration, episode.guid)
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from collections import namedtuple
+from lxml import etree
+
+ITUNES_DURATION = "{http://www.itunes.com/dtds/podcast-1.0.dtd}duration"
+
+# url: the enclosure url, or the guid if the item has no enclosure
+# length: the declared enclosure length in bytes or None
+# duration: the itunes:duration in seconds or None
+Episode = namedtuple("Episode", ["url", "length", "duration", "guid"])
+
+
+def parse_itunes_duration(duration):
+    """
+    Returns the seconds of an itunes:duration, which is either seconds or
+    HH:MM:SS / MM:SS, or None if it cannot be parsed.
+    """
+    if not duration:
+        return None
+    try:
+        seconds = 0.0
+        for part in duration.strip().split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+def __parse_length(length):
+    try:
+        return int(length) if length else None
+    except ValueError:
+        return None
+
+
+def iter_episodes(stream):
+    """
+    Yields an Episode for every item of the rss feed read from stream, a
+    binary file like object such as an open file or a raw http response.
+    """
+    for _, item in etree.iterparse(
+        stream, events=("end",), tag="item", recover=True, huge_tree=True
+    ):
+        enclosure = item.find("enclosure")
+        guid = item.findtext("guid")
+        url = enclosure.get("url") if enclosure is not None else None
+        length = enclosure.get("length") if enclosure is not None else None
+
+        if url or guid:
+            yield Episode(
+                url=(url or guid).strip(),
+                length=__parse_length(length),
+                duration=parse_itunes_duration(item.findtext(ITUNES_DURATION)),
+                guid=guid.strip() if guid else None,
+            )
+
+        # Free the item and everything parsed before it
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
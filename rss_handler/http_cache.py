@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the HTTPCache class, a persistent on-disk cache for
+    the rss handler keyed by URL.
+
+    For every URL a small json entry is stored with what we learned about
+    it, e.g. the ETag and Last-Modified headers of a feed or the
+    content-length and probed duration of an episode. Feeds also get their
+    body stored so that a conditional request answered with
+    304 Not Modified can be served from disk.
+
+    Entries older than ttl seconds are treated as missing, and the cache is
+    kept below max_bytes by removing the least recently used files.
+
+    Example:
+
+    cache = HTTPCache()
+    entry = cache.get(url) or {}
+    cache.update(url, content_length=1234)
+
+    # Store a body while it is being streamed to a parser
+    with CachingReader(cache, url, response.raw, etag=etag) as stream:
+        parse(stream)
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from utilities.utilities import cache_folder, evict_least_recently_used
+
+
+class HTTPCache:
+    def __init__(
+        self, folder=None, ttl=90 * 24 * 60 * 60, max_bytes=1024 * 1024 * 1024
+    ) -> None:
+        self.folder = Path(folder) if folder else cache_folder("http")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+
+    def __key(self, url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def __entry_path(self, url: str) -> Path:
+        return self.folder / f"{self.__key(url)}.json"
+
+    def body_path(self, url: str) -> Path:
+        return self.folder / f"{self.__key(url)}.body"
+
+    def __write(self, path: Path, data: bytes) -> None:
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, url: str):
+        """Returns the entry stored for url or None if missing or expired"""
+        path = self.__entry_path(url)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry.get("stored", 0) > self.ttl:
+            return None
+        os.utime(path)  # mark as recently used
+        return entry
+
+    def update(self, url: str, **fields) -> dict:
+        """Merges fields into the entry of url and returns the new entry"""
+        with self.__lock:
+            entry = self.get(url) or {"url": url, "stored": time.time()}
+            entry.update(fields)
+            self.__write(self.__entry_path(url), json.dumps(entry).encode("utf-8"))
+        return entry
+
+    def get_body(self, url: str):
+        """Returns the stored body of url or None"""
+        try:
+            with open(self.body_path(url), "rb") as f:
+                body = f.read()
+        except IOError:
+            return None
+        os.utime(self.body_path(url))
+        return body
+
+    def put_body(self, url: str, body: bytes, **fields) -> None:
+        """Stores the body of url, fields are stored in a fresh entry"""
+        self.__write(self.body_path(url), body)
+        self.__put_entry(url, fields)
+
+    def commit_body(self, url: str, written_path, **fields) -> None:
+        """Like put_body, for a body that has already been written to a file"""
+        os.replace(written_path, self.body_path(url))
+        self.__put_entry(url, fields)
+
+    def __put_entry(self, url: str, fields: dict) -> None:
+        with self.__lock:
+            entry = {"url": url, "stored": time.time()}
+            entry.update(fields)
+            self.__write(self.__entry_path(url), json.dumps(entry).encode("utf-8"))
+
+    def evict(self) -> int:
+        """Removes least recently used entries until the cache fits max_bytes"""
+        with self.__lock:
+            return evict_least_recently_used(self.folder, self.max_bytes)
+
+
+class CachingReader:
+    """
+    Wraps a binary stream and copies everything read from it to a temporary
+    file. Once the stream has been read to the end the file is stored as the
+    body of url in the cache, if it is closed before that nothing is stored.
+    """
+
+    def __init__(self, cache: HTTPCache, url: str, stream, **fields) -> None:
+        self.cache = cache
+        self.url = url
+        self.stream = stream
+        self.fields = fields
+        self.path = cache.body_path(url).with_name(
+            f"{cache.body_path(url).name}.{threading.get_ident()}.tmp"
+        )
+        self.file = open(self.path, "wb")
+
+    def read(self, size=-1) -> bytes:
+        data = self.stream.read(size)
+        if data:
+            self.file.write(data)
+        elif not self.file.closed:
+            self.file.close()
+            self.cache.commit_body(self.url, self.path, **self.fields)
+        return data
+
+    def close(self) -> None:
+        self.stream.close()
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -12,6 +12,23 @@
     rss_handler = RSSFeedsHandler(rss_feeds)
     rss_handler.get_total_lengths(print_feed_lengths = True)
 
+    With workers > 1 the feeds and the requests for their episodes are run
+    on thread pools over a shared keep-alive session, with at most per_host
+    requests to the same host at a time. Failed requests are retried with
+    backoff.
+
+    rss_handler = RSSFeedsHandler(rss_feeds, workers=16, per_host=4)
+
+    The duration of an episode is its itunes:duration if the feed has one.
+    Otherwise it is read from the headers of the audio file, of which only
+    the first few KB are requested, see utilities.audio_headers. ffprobe is
+    only used for files whose headers cannot be read.
+
+    With a cache, see http_cache.HTTPCache, feeds are fetched with conditional
+    requests and the duration of every episode is only estimated once.
+
+    rss_handler = RSSFeedsHandler(rss_feeds, cache=HTTPCache())
+
 """
 
 ___author___ = "Staffan Hedström"
@@ -19,24 +36,64 @@ ___license___ = "Apache 2.0"
 ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import time
 import requests
-import ffmpeg
 
+from rss_handler.feed_parser import iter_episodes
+from rss_handler.http_cache import CachingReader, HTTPCache
+from rss_handler.session import HostLimits, RangeReader, make_session
+from utilities.audio_headers import audio_duration
 from source_handler.handler import SourceHandler
 from utilities.utilities import seconds_to_hours_mins
 from tqdm import tqdm
 
 
 class RSSFeedsHandler:
-    def __init__(self, feeds: dict) -> None:
+    def __init__(
+        self,
+        feeds: dict,
+        workers=1,
+        per_host=4,
+        timeout=30,
+        retries=3,
+        backoff=0.5,
+        session=None,
+        cache=None,
+    ) -> None:
         self.feeds = feeds
+        self.cache = cache
+        self.workers = workers
+        self.timeout = timeout
+        self.session = session or make_session(max(workers, 10), retries, backoff)
+        self.host_limits = HostLimits(per_host)
+
+    def __episode_executor(self):
+        """
+        A pool for the episodes of all feeds of one call, so the total number
+        of requests stays bounded and no threads outlive the call
+        """
+        if self.workers > 1:
+            return ThreadPoolExecutor(self.workers)
+        return nullcontext()
 
     def get_total_length(self, print_feed_lengths=False) -> int:
 
         length = 0
-        for key, item in self.feeds.items():
-            feed_length = self.__get_feed_length(item)
+        names = list(self.feeds.keys())
+        with self.__episode_executor() as episodes:
+            get_feed_length = partial(self.__get_feed_length, executor=episodes)
+            if self.workers > 1 and len(names) > 1:
+                with ThreadPoolExecutor(min(self.workers, len(names))) as executor:
+                    feed_lengths = list(
+                        executor.map(get_feed_length, self.feeds.values())
+                    )
+            else:
+                feed_lengths = [get_feed_length(url) for url in self.feeds.values()]
+
+        for key, feed_length in zip(names, feed_lengths):
             hours, mins = seconds_to_hours_mins(feed_length)
 
             if print_feed_lengths:
@@ -48,43 +105,107 @@ class RSSFeedsHandler:
             total_hours, total_mins = seconds_to_hours_mins(length)
             print(f"Total: {total_hours} hours and {total_mins} minutes")
 
+        if self.cache:
+            self.cache.evict()
+
         return length
 
     def get_length_of_feed(self, name: str):
         if self.feeds[name]:
-            return self.__get_feed_length(self.feeds[name])
+            with self.__episode_executor() as episodes:
+                return self.__get_feed_length(self.feeds[name], episodes)
 
         return -1
 
-    def __get_sample_rate(self, url: str):
+    def __probe_duration(self, url: str) -> float:
+        import ffmpeg
+
         meta = ffmpeg.probe(url)
-        duration = eval(meta["format"]["duration"])
-        size = eval(meta["format"]["size"])
-        return int(round(size / duration))
-
-    def __get_duration_seconds(self, url: str, sample_rate: int):
-        return self.__get_length_from_url(url) / sample_rate
-
-    def __get_length_from_url(self, url: str):
-        r = requests.head(url)
-        content_length = r.headers["content-length"]
-        return int(content_length)
-
-    def __get_feed_length(self, url: str):
-        r = requests.get(url)
-        soup = BeautifulSoup(r.content, "lxml")
-        audio_urls = []
+        return float(meta["format"]["duration"])
+
+    def __get_episode_duration(self, episode) -> float:
+        if episode.duration is not None:
+            return episode.duration
+
+        entry = self.cache.get(episode.url) if self.cache else None
+        if entry and "duration" in entry:
+            return entry["duration"]
+
+        try:
+            with self.host_limits.limit(episode.url):
+                reader = RangeReader(self.session, episode.url, self.timeout)
+                duration = audio_duration(reader)
+        except (requests.RequestException, IOError, KeyError, ValueError):
+            duration = None
+        if duration is None:
+            duration = self.__probe_duration(episode.url)
+
+        if self.cache:
+            self.cache.update(episode.url, duration=duration)
+        return duration
+
+    def __request(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self.host_limits.limit(url):
+            r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def __open_feed(self, url: str):
+        """
+        Returns the feed at url as a binary stream that is read as it
+        downloads. With a cache the request is conditional, a 304 Not Modified
+        response is answered with the cached feed and a new feed is stored
+        while it is being read.
+        """
+        if not self.cache:
+            r = self.__request("GET", url, stream=True)
+            r.raw.decode_content = True
+            return r.raw
+
+        entry = self.cache.get(url) or {}
+        headers = {}
+        if self.cache.body_path(url).exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = self.__request("GET", url, headers=headers, stream=True)
+        if r.status_code == 304 and headers:
+            r.close()
+            try:
+                body = open(self.cache.body_path(url), "rb")
+                self.cache.update(url, stored=time.time())
+                return body
+            except IOError:  # evicted in the meantime
+                r = self.__request("GET", url, stream=True)
+
+        r.raw.decode_content = True
+        return CachingReader(
+            self.cache,
+            url,
+            r.raw,
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified"),
+        )
+
+    def __get_feed_length(self, url: str, executor=None):
         total_length_seconds = 0
-
-        for item in soup.find_all("item"):
-            audio_url = item.guid.string
-            audio_urls.append(audio_url)
-
-        sample_rate = self.__get_sample_rate(audio_urls[0])
-
-        for u in tqdm(audio_urls, desc=url):
-            duration = self.__get_duration_seconds(u, sample_rate)
-            total_length_seconds += int(duration)
+        durations = []
+
+        # Episodes are handled as they are parsed, while the feed downloads
+        with self.__open_feed(url) as feed:
+            for episode in tqdm(iter_episodes(feed), desc=url):
+                if executor:
+                    durations.append(
+                        executor.submit(self.__get_episode_duration, episode)
+                    )
+                else:
+                    duration = self.__get_episode_duration(episode)
+                    total_length_seconds += int(duration)
+
+        for duration in durations:
+            total_length_seconds += int(duration.result())
 
         return total_length_seconds
 
@@ -96,7 +217,7 @@ def main():
     # Get the rss dict {"name": "url"}
     rss_feeds = source_handler.get_rss_feeds()
 
-    rss_handler = RSSFeedsHandler(rss_feeds)
+    rss_handler = RSSFeedsHandler(rss_feeds, workers=16, cache=HTTPCache())
 
     length = rss_handler.get_total_length(print_feed_lengths=True)
     hours, mins = seconds_to_hours_mins(length)
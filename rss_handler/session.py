@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the HTTP plumbing shared by the rss handler classes.
+
+    make_session(pool_size, retries, backoff) -> requests.Session:
+    A session with a keep-alive connection pool that retries failed requests
+    with exponential backoff
+
+    HostLimits(per_host):
+    Limits how many requests are made to the same host at a time
+
+    with host_limits.limit(url):
+        session.get(url)
+
+    RangeReader(session, url):
+    Reads parts of a remote file with HTTP Range requests, a reader for
+    utilities.audio_headers
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from urllib.parse import urlsplit
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(pool_size=10, retries=3, backoff=0.5) -> requests.Session:
+    """
+    Returns a requests session that keeps up to pool_size connections alive
+    per host and retries failed requests with exponential backoff.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostLimits:
+    def __init__(self, per_host=4) -> None:
+        self.per_host = per_host
+        self.__limits = {}
+        self.__lock = threading.Lock()
+
+    def limit(self, url: str) -> threading.BoundedSemaphore:
+        """Returns the semaphore of the host of url, use it as a context"""
+        host = urlsplit(url).netloc
+        with self.__lock:
+            if host not in self.__limits:
+                self.__limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.__limits[host]
+
+
+class RangeReader:
+    def __init__(self, session: requests.Session, url: str, timeout=30) -> None:
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.size = None  # known after the first read
+
+    def read(self, offset: int, size: int) -> bytes:
+        headers = {"Range": f"bytes={offset}-{offset + size - 1}"}
+        r = self.session.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout
+        )
+        with r:
+            r.raise_for_status()
+            if r.status_code == 206:
+                self.size = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+            elif offset:
+                raise IOError(f"{self.url} does not support range requests")
+            else:
+                self.size = int(r.headers["Content-Length"])
+            # Only the requested bytes, even if the server sends everything
+            return r.raw.read(size)
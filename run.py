@@ -16,15 +16,40 @@
 
     this will for each source in input.json
 
+    0. With -dl, download the audio of the rss feed into the audio_dir
     1. Generate the folder structure in the output folder,
         see "generate_folder_structure" for details
     2.
-        a) -wave -> Convert audio to .wav and copy to output folder
+        a) -wave -> Convert audio to .wav and copy to output folder,
+            use -j N to run N conversions in parallel
         b) -gas -> Generate audio symlinks in the audio folder for the source
         c) -ca -> Copy the audio files to the output folder
     3. Convert text documents to .txt files
-        and put them into the text folder for the source
+        and put them into the text folder for the source,
+        also in parallel when -j N is given
     4. Generate a new mappings.tsv file
+    5. With -pack, pack each source into tar shards with an index for
+        training, see corpus_handler/packer.py
+
+    With --shard i/N only part i of N of the pairs of every source is
+    processed, so that N machines can share the work, and the files keep
+    their original names. The output folders of the N runs are then joined
+    with -merge, which puts the files in place without converting them again
+    and numbers them as one run would have, see merge_shards:
+
+    python run.py -i input.json -o part_0 -wave --shard 0/2  # on machine 0
+    python run.py -i input.json -o part_1 -wave --shard 1/2  # on machine 1
+    python run.py -i input.json -o output_folder -merge part_0 part_1
+
+    Steps 1 to 5 run per source as soon as the steps they depend on are
+    done, so different sources, and the audio and text of one source, are
+    processed at the same time with -j N. The output is the same as when
+    the steps run one after another.
+
+    A manifest.json is kept in the folder of each source so that re-runs only
+    process new or changed files, use -force to process everything again.
+    The renames of step 4 are journaled, an interrupted run is finished by
+    the next one or rolled back with -rollback.
 
 
 """
@@ -33,17 +58,53 @@ ___author___ = "Staffan Hedström"
 ___license___ = "Apache 2.0"
 ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
+from typing import TYPE_CHECKING
 from source_handler.handler import Source, SourceHandler
-from document_handler.document_to_text import DocumentReader
-from utilities.utilities import copy_and_convert_to_wav
+from source_handler.inventory import build_inventories
+from document_handler.document_to_text import convert_document, extractor_version
+from document_handler.text_cache import TextCache
+from corpus_handler.packer import pack_source
+from utilities.utilities import (
+    convert_batch_to_wav,
+    run_in_pool,
+    shard_of,
+    to_wav_path,
+)
+from utilities.manifest import SourceManifest, load_manifests
+from utilities.materialize import LINK_MODES, materialize
+from utilities.rename_journal import RenameJournal
+from utilities.scheduler import Scheduler
+from utilities.metrics import Metrics
 import os
 import logging
 import argparse
-import pandas as pd
-from pathlib import Path
+import json
 import shutil
+import time
+from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+# pandas and the document and audio backends are imported by the steps that
+# use them, so that e.g. run.py -h or a run with -sd starts fast
+if TYPE_CHECKING:
+    import pandas as pd
+
+STAGES = (
+    "download",
+    "folders",
+    "recovery",
+    "matching",
+    "merging",
+    "audio",
+    "text",
+    "standardization",
+    "packing",
+)
+# Written next to mapping.tsv by a run with --shard
+SHARD_FILE = "shard.json"
+
 
 def generate_folder_structure(source_names: list, destination) -> None:
     """
@@ -59,6 +120,10 @@ def generate_folder_structure(source_names: list, destination) -> None:
             |___audio/
             |___text/
         ...
+
+    With files_per_folder in map_and_standardize_filenames the audio and
+    text folders get numbered subfolders, e.g. audio/000/, which are made
+    when the files are renamed.
     """
     for name in tqdm(source_names, "Generating folders"):
         path = os.path.join(destination, name)
@@ -72,16 +137,44 @@ def generate_folder_structure(source_names: list, destination) -> None:
             logging.warning(f"Folder {audio_path} or {text_path} already exists")
 
 
-def generate_txt_files(sources: list, destination) -> None:
+def generate_txt_files(
+    sources: list,
+    destination,
+    jobs=1,
+    manifests=None,
+    inventories=None,
+    text_cache=None,
+    executor=None,
+    metrics=None,
+) -> None:
     """
     Converts all text files to txt files and places them in the
     destination / source_name / text folder.
+
+    The documents of all sources are converted on a pool of jobs worker
+    processes, a document that cannot be read is logged and skipped.
+
+    Documents that have not changed since they were recorded in the manifest
+    of the source are skipped, see utilities.manifest.
+
+    With a text_cache, see document_handler.text_cache, documents that have
+    been converted before, in any source, are copied from the cache.
+
+    With an executor the documents are converted on that shared pool.
+
+    With metrics, see utilities.metrics, every conversion is timed.
     """
-    reader = DocumentReader()
+    import pandas as pd
+
+    sources = [source for source in sources if isinstance(source, Source)]
+    if manifests is None:
+        manifests = load_manifests(sources, destination)
+    if inventories is None:
+        inventories = build_inventories(sources)
+    conversions = []
+    owners = {}
 
     for source in sources:
-        if not isinstance(source, Source):
-            continue
         if not os.path.exists(source.text_dir):
             logging.error(
                 f"Audio path for {source.name_ascii} \
@@ -97,90 +190,314 @@ def generate_txt_files(sources: list, destination) -> None:
             continue
 
         mapping = pd.read_csv(mapping_file, sep="\t")
+        manifest = manifests[source.name_ascii]
+        text_files = inventories[source.name_ascii].text
         text_dest_folder = os.path.join(destination, source.name_ascii, "text")
-        for root, dirs, files in os.walk(source.text_dir):
-            for file in tqdm(files, f"Converting documents for {source.name_ascii}"):
-                if file in mapping.text.values:
-                    reader.read(os.path.join(root, file))
-                    reader.save(os.path.join(text_dest_folder, file))
-
-
-def generate_audio(sources: list, destination, copy=False, wave=False) -> None:
+        up_to_date = 0
+        for file in mapping.text.unique():
+            if file not in text_files:
+                continue
+            input_path, stat = text_files[file]
+            if manifest.is_current(
+                "text", file, input_path, mode=source.text_extraction, stat=stat
+            ):
+                up_to_date += 1
+                continue
+            manifest.forget("text", file)
+            args = (
+                input_path,
+                os.path.join(text_dest_folder, file),
+                str(text_cache.folder) if text_cache else None,
+                source.text_extraction,
+            )
+            conversions.append(args)
+            owners[args] = (manifest, file, stat, source.name_ascii)
+        logging.info(f"{up_to_date} documents up to date for {source.name_ascii}")
+
+    if conversions:
+        timings = [] if metrics else None
+        results = run_in_pool(
+            convert_document,
+            conversions,
+            jobs,
+            "Converting documents",
+            executor,
+            timings,
+        )
+        for args, txt_path in results:
+            if txt_path:
+                manifest, file, stat, _ = owners[args]
+                manifest.record(
+                    "text",
+                    file,
+                    args[0],
+                    Path(txt_path).name,
+                    mode=args[3],
+                    stat=stat,
+                )
+        for args, seconds, cpu_seconds, peak_rss, pooled in timings or []:
+            stat, source_name = owners[args][2:]
+            metrics.add_file(
+                "text",
+                source_name,
+                args[0],
+                stat.st_size,
+                seconds,
+                *((cpu_seconds, peak_rss) if pooled else ()),
+            )
+        if text_cache:
+            text_cache.evict()
+
+    for manifest in manifests.values():
+        manifest.save()
+
+
+def generate_audio(
+    sources: list,
+    destination,
+    copy=False,
+    wave=False,
+    jobs=1,
+    manifests=None,
+    inventories=None,
+    batch_size=8,
+    link_mode=None,
+    executor=None,
+    metrics=None,
+) -> None:
     """
     Generates audio symlinks into the destination path for each source.
 
     Uses the source audio dir to find the original audio files, and for each
     creates a symlink in the destination / source_name / audio folder.
 
+    With copy the files are copied instead. link_mode picks how, one of
+    utilities.materialize.LINK_MODES, and overrides copy. The method used
+    for each file is logged and stored in the manifest.
+
+    When converting to wave the conversions of all sources are gathered first
+    and then run on a pool of jobs worker processes, see run_in_pool. Each
+    worker converts batch_size files with one ffmpeg process and only copies
+    files that already are 16 kHz mono wav, see convert_batch_to_wav. With
+    an executor the batches run on that shared pool.
+
+    With metrics, see utilities.metrics, every file, or batch of files
+    converted by one ffmpeg process, is timed.
+
+    Audio files that have not changed since they were recorded in the
+    manifest of the source are skipped, see utilities.manifest.
+
     This relies on that the folder structure has already been created.
     This also relies on that the matching mappings file has been generated.
     """
+    import pandas as pd
+
+    sources = [source for source in sources if isinstance(source, Source)]
+    if manifests is None:
+        manifests = load_manifests(sources, destination)
+    if inventories is None:
+        inventories = build_inventories(sources)
+    if link_mode is None:
+        link_mode = "copy" if copy else "symlink"
+    mode = "wave" if copy and wave else link_mode
+    conversions = []
+    owners = {}
     for source in sources:
-        if isinstance(source, Source):
-            if not os.path.exists(source.audio_path):
-                logging.error(
-                    f"Audio path for {source.name_ascii} \
-                        cannot be found: '{source.audio_path}'"
-                )
+        if not os.path.exists(source.audio_path):
+            logging.error(
+                f"Audio path for {source.name_ascii} \
+                    cannot be found: '{source.audio_path}'"
+            )
+            continue
+        mapping = pd.read_csv(
+            Path(destination, source.name_ascii, "mapping.tsv"), sep="\t"
+        )
+        manifest = manifests[source.name_ascii]
+        audio_files = inventories[source.name_ascii].audio
+        audio_folder = os.path.join(destination, source.name_ascii, "audio")
+        logging.info(f"Found {len(audio_files)} audio files for {source.name_ascii}")
+        methods = Counter()
+        for file in tqdm(
+            mapping.audio.unique(), f"Generating audio for: {source.name_ascii}"
+        ):
+            # If file is not in the source folder, then skip it
+            if file not in audio_files:
+                continue
+            input_path, stat = audio_files[file]
+            if manifest.is_current("audio", file, input_path, mode=mode, stat=stat):
                 continue
-            mapping = pd.read_csv(
-                Path(destination, source.name_ascii, "mapping.tsv"), sep="\t"
+            manifest.forget("audio", file)
+            try:
+                if copy and wave:
+                    output_path = os.path.join(audio_folder, file)
+                    conversions.append((input_path, output_path))
+                    owners[to_wav_path(output_path)] = (
+                        manifest,
+                        file,
+                        stat,
+                        source.name_ascii,
+                    )
+                    continue
+                # Symlinks by default to save space
+                output_path = os.path.join(audio_folder, file)
+                start = time.perf_counter()
+                method = materialize(input_path, output_path, link_mode)
+                if metrics:
+                    metrics.add_file(
+                        "audio",
+                        source.name_ascii,
+                        input_path,
+                        stat.st_size,
+                        time.perf_counter() - start,
+                    )
+                logging.debug(f"Made '{output_path}' with {method}")
+                methods[method] += 1
+                manifest.record(
+                    "audio", file, input_path, file, mode=mode, stat=stat, method=method
+                )
+
+            except FileExistsError:
+                logging.warn(
+                    f"File: '{os.path.join(audio_folder, file)}' already exits"
+                )
+        if methods:
+            logging.info(f"Audio of {source.name_ascii} made with {dict(methods)}")
+
+    if conversions:
+        # Conformant wavs are put in place with the link mode, not converted
+        batches = [
+            (conversions[i : i + batch_size], link_mode)
+            for i in range(0, len(conversions), batch_size)
+        ]
+        timings = [] if metrics else None
+        results = run_in_pool(
+            convert_batch_to_wav,
+            batches,
+            jobs,
+            "Converting to wave",
+            executor,
+            timings,
+        )
+        for _, converted in results:
+            for input_path, wav_path, method in converted:
+                manifest, file, stat, _ = owners[wav_path]
+                logging.debug(f"Made '{wav_path}' with {method}")
+                manifest.record(
+                    "audio",
+                    file,
+                    input_path,
+                    Path(wav_path).name,
+                    mode=mode,
+                    stat=stat,
+                    method=method,
+                )
+        for (batch, _), seconds, cpu_seconds, peak_rss, pooled in timings or []:
+            # One ffmpeg process converts the batch, so it is timed as a whole,
+            # for the source of its first file
+            inputs = [input_path for input_path, _ in batch]
+            owned = [owners[to_wav_path(output_path)] for _, output_path in batch]
+            metrics.add_file(
+                "audio",
+                owned[0][3],
+                inputs[0] if len(inputs) == 1 else f"{inputs[0]} (+{len(inputs) - 1})",
+                sum(stat.st_size for _, _, stat, _ in owned),
+                seconds,
+                *((cpu_seconds, peak_rss) if pooled else (None, None)),
+                files=len(inputs),
             )
-            audio_folder = os.path.join(destination, source.name_ascii, "audio")
-            for root, dirs, files in os.walk(source.audio_path):
-                logging.info(f"Found {len(files)} audio files for {source.name_ascii}")
-                for file in tqdm(files, f"Generating audio for: {source.name_ascii}"):
-                    # If file not in the matching mapping file, then skip it
-                    if file not in mapping.audio.values:
-                        continue
-                    try:
-                        if copy and wave:
-                            copy_and_convert_to_wav(
-                                os.path.join(root, file),
-                                os.path.join(audio_folder, file),
-                            )
-                        elif copy:
-                            shutil.copy(Path(root, file), Path(audio_folder, file))
-                        else:  # else create symlinks to save space
-                            os.symlink(
-                                os.path.join(root, file),
-                                os.path.join(audio_folder, file),
-                            )
-
-                    except FileExistsError:
-                        logging.warn(
-                            f"File: '{os.path.join(audio_folder, file)}' already exits"
-                        )
-
-
-def make_matching_maps(sources: list, destination: str) -> None:
+
+    for manifest in manifests.values():
+        manifest.save()
+
+
+def make_matching_maps(
+    sources: list, destination: str, inventories=None, shard=None, metrics=None
+) -> None:
+    """
+    Writes a mapping.tsv for each source with the rows of the source mapping
+    file that have both their text and audio file in the source folders.
+
+    The rows that are missing either file are written to unmatched.tsv next
+    to it, with a missing_text and missing_audio column.
+
+    With shard, an (i, N) tuple, only the rows whose audio file name falls in
+    part i of N are kept, see utilities.shard_of. Their position among all
+    matching rows is kept in a row column and the part is written to
+    shard.json, for merge_shards.
+
+    With metrics, see utilities.metrics, the matched rows are counted as
+    files and the unmatched rows as unmatched_rows.
+    """
+    import pandas as pd
+
+    if inventories is None:
+        inventories = build_inventories(
+            [source for source in sources if isinstance(source, Source)]
+        )
     for source in tqdm(sources, "Making mapping files."):
-        if not isinstance(source, Source) or not Path(source.mapping_file).exists:
+        if not isinstance(source, Source) or not Path(source.mapping_file).exists():
             logging.error(
                 f"Cannot find the mapping file: {source.mapping_file} for {source}"
             )
             continue
 
         mapping = pd.read_csv(source.mapping_file, sep="\t")
-        audio_files = os.listdir(source.audio_path)
-        text_files = os.listdir(source.text_dir)
-
-        matching_audio = []
-        matching_text = []
-
-        for row in mapping.iterrows():
-            if row[1].text in text_files and row[1].audio in audio_files:
-                matching_audio.append(row[1].audio)
-                matching_text.append(row[1].text)
-
-        matching_mapping = pd.DataFrame()
-        matching_mapping["text"] = matching_text
-        matching_mapping["audio"] = matching_audio
-
-        matching_mapping.to_csv(
+        audio_files = inventories[source.name_ascii].audio
+        text_files = inventories[source.name_ascii].text
+
+        has_text = mapping.text.isin(text_files.keys())
+        has_audio = mapping.audio.isin(audio_files.keys())
+        matching = has_text & has_audio
+
+        matched = mapping.loc[matching, ["text", "audio"]]
+        shard_path = Path(destination, source.name_ascii, SHARD_FILE)
+        if shard:
+            index, shards = shard
+            matched = matched.assign(row=range(len(matched)))
+            matched = matched[
+                matched.audio.map(lambda name: shard_of(name, shards)) == index
+            ]
+            with open(shard_path, "w") as f:
+                json.dump(
+                    {"shard": index, "shards": shards, "rows": int(matching.sum())}, f
+                )
+        elif shard_path.exists():
+            shard_path.unlink()
+        matched.to_csv(
             Path(destination, source.name_ascii, "mapping.tsv"), sep="\t", index=False
         )
 
+        unmatched_path = Path(destination, source.name_ascii, "unmatched.tsv")
+        unmatched = mapping.loc[~matching, ["text", "audio"]]
+        if len(unmatched):
+            unmatched = unmatched.assign(
+                missing_text=~has_text[~matching], missing_audio=~has_audio[~matching]
+            )
+            unmatched.to_csv(unmatched_path, sep="\t", index=False)
+            logging.warning(
+                f"{len(unmatched)} rows of {source.mapping_file} are missing \
+                    {unmatched.missing_text.sum()} text and \
+                    {unmatched.missing_audio.sum()} audio files, \
+                    see {unmatched_path}"
+            )
+        elif unmatched_path.exists():
+            unmatched_path.unlink()
+        if metrics:
+            metrics.add(
+                "matching",
+                source.name_ascii,
+                files=len(matched),
+                unmatched_rows=len(unmatched),
+            )
+
+        unused_audio = len(audio_files) - mapping.audio[has_audio].nunique()
+        unused_text = len(text_files) - mapping.text[has_text].nunique()
+        if unused_audio or unused_text:
+            logging.info(
+                f"{unused_audio} audio and {unused_text} text files of \
+                    {source.name_ascii} are not in its mapping file"
+            )
+
 
 def __format_audio_mapping(path: str) -> str:
     return str(Path("audio") / Path(path).name)
@@ -190,11 +507,15 @@ def __format_text_mapping(path: str) -> str:
     return str(Path("text") / f"{Path(path).stem}.txt")
 
 
-def map_and_standardize_filenames(sources: list, destination) -> None:
+def map_and_standardize_filenames(
+    sources: list, destination, manifests=None, files_per_folder=0, metrics=None
+) -> None:
+    import pandas as pd
+
+    sources = [source for source in sources if isinstance(source, Source)]
+    if manifests is None:
+        manifests = load_manifests(sources, destination)
     for source in tqdm(sources, "Standardizing filenames."):
-        if not isinstance(source, Source):
-            logging.error(f"Cannot read source: {source}")
-            continue
         mapping_path = Path(destination, source.name_ascii, "mapping.tsv")
         if not mapping_path.exists():
             logging.error(f"Cannot find the mapping file: {mapping_path} for {source}")
@@ -208,17 +529,120 @@ def map_and_standardize_filenames(sources: list, destination) -> None:
         mapping.audio = mapping.audio.apply(__format_audio_mapping)
         mapping.text = mapping.text.apply(__format_text_mapping)
 
-        mapping = standardize_files(mapping, destination, source.name_ascii)
+        # Writes the new mapping.tsv once all files are renamed
+        standardize_files(
+            mapping,
+            destination,
+            source.name_ascii,
+            manifests[source.name_ascii],
+            files_per_folder=files_per_folder,
+            metrics=metrics,
+        )
+
 
-        # Check if file exists?
-        mapping.to_csv(
-            Path(destination, source.name_ascii, "mapping.tsv"), sep="\t", index=False
+def __record_renames(plan: "pd.DataFrame", manifest) -> None:
+    if manifest is None:
+        return
+    for stage, original, target in zip(plan.stage, plan.original, plan.target):
+        manifest.set_output(stage, original, target)
+    manifest.save()
+
+
+def __park(path: Path) -> None:
+    parked = path.with_name(f"{path.name}.orphaned")
+    number = 0
+    while os.path.lexists(parked):
+        number += 1
+        parked = path.with_name(f"{path.name}.orphaned.{number}")
+    os.rename(path, parked)
+    logging.warning(f"{path} is not in the mapping, moved it to {parked}")
+
+
+def __forget_removed_rows(mapping: "pd.DataFrame", manifest, source_name) -> None:
+    """
+    Drops the manifest entries of files that are no longer in the mapping and
+    removes their outputs, which hold standardized names that the files of
+    the mapping may be renumbered to.
+    """
+    removed = 0
+    for stage, column in (
+        ("audio", "original_audio_name"),
+        ("text", "original_text_name"),
+    ):
+        for name in set(manifest.outputs(stage)) - set(mapping[column]):
+            manifest.forget(stage, name)
+            removed += 1
+    if removed:
+        manifest.save()
+        logging.info(
+            f"Removed {removed} files of {source_name} no longer in its mapping"
         )
 
 
+def plan_renames(
+    mapping_dataframe: "pd.DataFrame", source_name, manifest=None, files_per_folder=0
+) -> "pd.DataFrame":
+    """
+    Returns the rename plan of standardize_files, one row per file with its
+    stage, original name, current name and target name, with the new names
+    set in mapping_dataframe.
+
+    With files_per_folder the new names are put in numbered subfolders of
+    that many files, e.g. 000/source_name_000123.wav for 1000.
+    """
+    import pandas as pd
+
+    numbers = pd.Series(mapping_dataframe.index + 1, index=mapping_dataframe.index)
+    new_names = source_name + "_" + numbers.astype(str).str.zfill(6)
+    if files_per_folder:
+        buckets = ((numbers - 1) // files_per_folder).astype(str).str.zfill(3)
+        new_names = buckets + "/" + new_names
+
+    audio = mapping_dataframe.audio.str.rsplit("/", n=1).str[-1]
+    text = mapping_dataframe.text.str.rsplit("/", n=1).str[-1]
+    if manifest is not None:
+        audio = mapping_dataframe.original_audio_name.map(
+            manifest.outputs("audio")
+        ).fillna(audio)
+        text = mapping_dataframe.original_text_name.map(
+            manifest.outputs("text")
+        ).fillna(text)
+    audio_format = audio.str.extract(r"(\.[^./]*)$", expand=False).fillna("")
+
+    mapping_dataframe.audio = new_names + audio_format
+    mapping_dataframe.text = new_names + ".txt"
+
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "stage": "audio",
+                    "original": mapping_dataframe.original_audio_name,
+                    "current": audio,
+                    "target": mapping_dataframe.audio,
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "stage": "text",
+                    "original": mapping_dataframe.original_text_name,
+                    "current": text,
+                    "target": mapping_dataframe.text,
+                }
+            ),
+        ],
+        ignore_index=True,
+    )
+
+
 def standardize_files(
-    mapping_dataframe: pd.DataFrame, destination, source_name
-) -> pd.DataFrame:
+    mapping_dataframe: "pd.DataFrame",
+    destination,
+    source_name,
+    manifest=None,
+    files_per_folder=0,
+    metrics=None,
+) -> "pd.DataFrame":
     """
     Standardizes the files in the destination folder according to
     source_name_000XX.txt
@@ -226,31 +650,250 @@ def standardize_files(
 
     Uses the data in the mapping_dataframe to rename the files so
     that the audio file and matching text file have matching names.
+    With files_per_folder they are spread over numbered subfolders, see
+    plan_renames, and the mapping paths include the subfolder.
+
+    With a manifest the current names of the files are taken from it, files
+    that already have their standardized name are left alone and the
+    manifest is updated with the new names. Files of rows that have left
+    the mapping are removed first, see __forget_removed_rows.
+
+    All renames are planned up front and written to a RenameJournal before
+    any file is touched, so an interrupted run is finished (or rolled back
+    with -rollback) by recover_renames on the next run.
+
+    With metrics, see utilities.metrics, the renamed files are counted.
+    """
+    import pandas as pd
+
+    folder = Path(destination, source_name)
+    if manifest is not None:
+        __forget_removed_rows(mapping_dataframe, manifest, source_name)
+    plan = plan_renames(mapping_dataframe, source_name, manifest, files_per_folder)
+    plan = plan[plan.current != plan.target]
+
+    exists = pd.Series(
+        [
+            os.path.lexists(folder / stage / name)
+            for stage, name in zip(plan.stage, plan.current)
+        ],
+        index=plan.index,
+        dtype=bool,
+    )
+    for stage, name in zip(plan.stage[~exists], plan.current[~exists]):
+        # e.g. an audio file that could not be converted
+        logging.error(f"Cannot find {folder / stage / name}, not renaming it")
+    plan = plan[exists]
+
+    # A target held by a file that is not in the plan, e.g. an output of a
+    # run without a manifest, is moved aside instead of overwritten
+    planned = set(plan.stage + "/" + plan.current)
+    for stage, target in zip(plan.stage, plan.target):
+        target_path = folder / stage / target
+        if f"{stage}/{target}" not in planned and os.path.lexists(target_path):
+            __park(target_path)
+
+    # A file may have to move to a name that another file still holds, e.g.
+    # when new rows shifted the numbering. Those are parked first.
+    taken = (plan.stage + "/" + plan.current).isin(plan.stage + "/" + plan.target)
+    plan = plan.assign(temporary=(plan.current + ".renaming").where(taken, ""))
+
+    journal = RenameJournal(folder)
+    journal.start(plan, mapping_dataframe)
+    __record_renames(journal.apply(), manifest)
+    journal.finish()
+    if metrics:
+        metrics.add("standardization", source_name, files=len(plan))
+
+    # Subfolders left empty, e.g. after files_per_folder was changed
+    for subfolder in {
+        (folder / stage / name).parent for stage, name in zip(plan.stage, plan.current)
+    } - {folder / "audio", folder / "text"}:
+        try:
+            subfolder.rmdir()
+        except OSError:
+            pass
+
+    return mapping_dataframe
+
+
+def recover_renames(sources: list, destination, manifests=None, rollback=False) -> None:
+    """
+    Finishes the renames of standardize_files that were interrupted, or
+    with rollback moves the files back to their names before it started.
     """
-    audio_new_files = []
-    text_new_files = []
+    sources = [source for source in sources if isinstance(source, Source)]
+    if manifests is None:
+        manifests = load_manifests(sources, destination)
+    for source in sources:
+        journal = RenameJournal(Path(destination, source.name_ascii))
+        if not journal.exists():
+            continue
+        if rollback:
+            logging.warning(f"Rolling back the interrupted renames of {source.name}")
+            journal.rollback()
+        else:
+            logging.warning(f"Finishing the interrupted renames of {source.name}")
+            __record_renames(journal.apply(), manifests[source.name_ascii])
+            journal.finish()
+
+
+def __same_input(entry: dict, other: dict) -> bool:
+    keys = ("input", "size", "mtime", "mode", "hash")
+    return all(entry.get(key) == other.get(key) for key in keys)
+
+
+def merge_shards(
+    sources: list,
+    destination,
+    shard_folders: list,
+    manifests=None,
+    link_mode="reflink",
+    metrics=None,
+) -> None:
+    """
+    Joins the output folders of the runs with --shard i/N of every source
+    into destination, so that standardize_files numbers the files as if one
+    run had made them all.
 
-    audio_folder = Path(destination, source_name, "audio")
-    text_folder = Path(destination, source_name, "text")
+    The files of the shards are put in place with link_mode, see
+    utilities.materialize, and are not converted again. Symlinks, e.g. to
+    the source audio, are made again and other files are never symlinked,
+    so the shard folders can be removed afterwards. Their mapping.tsv
+    are joined in the order of the rows before sharding and their manifests
+    are merged, files that were merged before are skipped.
 
-    for row in mapping_dataframe.iterrows():
-        file_number = row[0] + 1
-        audio = f"{Path(row[1].audio).name}"
-        audio_format = Path(row[1].audio).suffix
-        text = f"{Path(row[1].text).stem}.txt"
-        audio_new_name = f"{source_name}_{str(file_number).zfill(6)}{audio_format}"
-        text_new_name = f"{source_name}_{str(file_number).zfill(6)}.txt"
+    A source that is missing a shard, or rows of one, is not merged and
+    raises a ValueError.
 
-        os.rename(Path(audio_folder, audio), Path(audio_folder, audio_new_name))
-        os.rename(Path(text_folder, text), Path(text_folder, text_new_name))
+    With metrics, see utilities.metrics, the merged files are counted.
+    """
+    import pandas as pd
 
-        audio_new_files.append(audio_new_name)
-        text_new_files.append(text_new_name)
+    sources = [source for source in sources if isinstance(source, Source)]
+    if manifests is None:
+        manifests = load_manifests(sources, destination)
+    for source in sources:
+        folder = Path(destination, source.name_ascii)
+        parts = [
+            Path(shard_folder, source.name_ascii) for shard_folder in shard_folders
+        ]
+        infos = []
+        for part in parts:
+            with open(part / SHARD_FILE, "r") as f:
+                infos.append(json.load(f))
+        shards = {info["shards"] for info in infos}
+        found = sorted(info["shard"] for info in infos)
+        if len(shards) != 1 or found != list(range(shards.pop())):
+            raise ValueError(
+                f"Got the shards {found} of {source.name_ascii}, \
+                    each shard of a --shard i/N run is needed once"
+            )
 
-    mapping_dataframe.text = text_new_files
-    mapping_dataframe.audio = audio_new_files
+        mapping = pd.concat(
+            [pd.read_csv(part / "mapping.tsv", sep="\t") for part in parts]
+        ).sort_values("row")
+        rows = {info["rows"] for info in infos}
+        if len(rows) != 1 or mapping.row.tolist() != list(range(rows.pop())):
+            raise ValueError(
+                f"The shards of {source.name_ascii} do not have the same rows, \
+                    were they made from the same mapping file and sources?"
+            )
+
+        manifest = manifests[source.name_ascii]
+        merged = size = 0
+        for part in parts:
+            for stage, entries in SourceManifest(part).entries.items():
+                for name, entry in entries.items():
+                    current = manifest.entry(stage, name)
+                    if (
+                        current
+                        and __same_input(current, entry)
+                        and os.path.lexists(manifest.output_path(stage, name))
+                    ):
+                        continue
+                    manifest.forget(stage, name)
+                    input_path = part / stage / entry["output"]
+                    method = "reflink" if link_mode == "symlink" else link_mode
+                    if input_path.is_symlink():
+                        input_path, method = input_path.resolve(), "symlink"
+                    output_path = folder / stage / entry["output"]
+                    if os.path.lexists(output_path):
+                        os.remove(output_path)
+                    materialize(input_path, output_path, method)
+                    manifest.add_entry(stage, name, entry)
+                    merged += 1
+                    size += os.path.getsize(input_path)
+        manifest.save()
+
+        mapping[["text", "audio"]].to_csv(folder / "mapping.tsv", sep="\t", index=False)
+        if (parts[0] / "unmatched.tsv").exists():
+            shutil.copyfile(parts[0] / "unmatched.tsv", folder / "unmatched.tsv")
+        logging.info(
+            f"Merged {len(parts)} shards of {source.name_ascii}, {merged} new files"
+        )
+        if metrics:
+            metrics.add("merging", source.name_ascii, files=merged, bytes=size)
+
+
+def pack_sources(
+    sources: list,
+    destination,
+    shard_size=1024**3,
+    jobs=1,
+    executor=None,
+    metrics=None,
+) -> None:
+    """
+    Packs the standardized files of each source into tar shards. With
+    metrics, see utilities.metrics, the packing of each source is timed.
+    """
+    sources = [source for source in sources if isinstance(source, Source)]
+    arguments = []
+    for source in sources:
+        folder = Path(destination, source.name_ascii)
+        if not (folder / "mapping.tsv").exists():
+            logging.error(f"Cannot find the mapping file of {source.name}, not packing")
+            continue
+        arguments.append((folder, shard_size))
+    timings = [] if metrics else None
+    results = run_in_pool(
+        pack_source, arguments, jobs, "Packing shards", executor, timings
+    )
+    if metrics:
+        workers = {
+            folder: {"worker_cpu_seconds": cpu_seconds, "peak_worker_rss_mb": peak_rss}
+            for (folder, _), _, cpu_seconds, peak_rss, pooled in timings
+            if pooled
+        }
+        for (folder, _), index in results:
+            metrics.add(
+                "packing",
+                folder.name,
+                files=len(index),
+                bytes=int(index["size"].sum()),
+                **workers.get(folder, {}),
+            )
+
+
+def __list_and_match(
+    source, destination, inventories: dict, shard=None, metrics=None
+) -> None:
+    # The listing is shared by the audio and text steps of the source
+    inventories.update(build_inventories([source]))
+    make_matching_maps(
+        [source], destination, inventories=inventories, shard=shard, metrics=metrics
+    )
 
-    return mapping_dataframe
+
+def __parse_shard(value: str) -> tuple:
+    try:
+        index, shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not of the form i/N")
+    if not 0 <= index < shards:
+        raise argparse.ArgumentTypeError(f"i must be from 0 to N - 1 in '{value}'")
+    return index, shards
 
 
 def main():
@@ -300,6 +943,17 @@ def main():
         action="store_true",
     )
 
+    parser.add_argument(
+        "-lm",
+        "--link_mode",
+        required=False,
+        help="How audio is put into the output folder, takes precedence over -gas \
+            and -ca. reflink falls back to hardlink and then to copy, hardlink to \
+            copy.",
+        choices=LINK_MODES,
+        default=None,
+    )
+
     parser.add_argument(
         "-wave",
         "--convert_to_wave",
@@ -308,6 +962,174 @@ def main():
         action="store_true",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        help="Number of worker processes used for conversions. default=1",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-dl",
+        "--download_audio",
+        required=False,
+        help="Use this flag to first download the audio of each source's rss feed \
+            into its audio_dir. Complete files are skipped and partial ones resumed.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--max_download_rate",
+        required=False,
+        help="Limit the total download speed to this many bytes per second.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--connections_per_host",
+        required=False,
+        help="Number of downloads from the same host at a time. default=2",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "-tc",
+        "--text_cache",
+        required=False,
+        help="Use this flag to cache the text extracted from documents by their \
+            content, so documents seen before in any source are not parsed again.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--text_cache_dir",
+        required=False,
+        help="Folder of the text cache. default=~/.cache/speech-corpus-tools/text",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--text_cache_size",
+        required=False,
+        help="Size limit of the text cache in MB. default=2048",
+        type=int,
+        default=2048,
+    )
+
+    parser.add_argument(
+        "-force",
+        "--force_rerun",
+        required=False,
+        help="Use this flag to process all files again, even if they are up to date.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-hash",
+        "--hash_inputs",
+        required=False,
+        help="Use this flag to also compare the content hash of inputs whose \
+            modification time changed before processing them again.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-batch",
+        "--ffmpeg_batch_size",
+        required=False,
+        help="Number of files converted by each ffmpeg process. default=8",
+        type=int,
+        default=8,
+    )
+
+    parser.add_argument(
+        "-fpf",
+        "--files_per_folder",
+        required=False,
+        help="Put the standardized files in numbered subfolders of this many files, \
+            e.g. audio/000/source_000123.wav, for very large sources. \
+            default=0 (all files in one folder)",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "-pack",
+        "--pack_shards",
+        required=False,
+        help="Use this flag to pack each source into tar shards with an index of \
+            byte offsets after standardizing, in the shards folder of the source.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--shard_size",
+        required=False,
+        help="Size of each tar shard in MB. default=1024",
+        type=int,
+        default=1024,
+    )
+
+    parser.add_argument(
+        "-rollback",
+        "--rollback_renames",
+        required=False,
+        help="Use this flag to move the files of an interrupted standardization back \
+            to their names before it started, instead of finishing it.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--shard",
+        required=False,
+        help="Process only part i of N of the pairs of every source, given as i/N, \
+            e.g. 0/4, to share the work between N machines. The files are not \
+            standardized or packed, join the outputs of the N runs with -merge.",
+        type=__parse_shard,
+        default=None,
+    )
+
+    parser.add_argument(
+        "-merge",
+        "--merge_shards",
+        required=False,
+        help="Output folders of runs with --shard i/N to join into the output \
+            folder, with the link mode of -lm, reflink by default, before \
+            standardizing and packing. Nothing is converted again.",
+        nargs="+",
+        metavar="FOLDER",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        required=False,
+        help="Write the time, CPU time, memory, file counts and throughput of each \
+            step and source to this JSON file.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--metrics_slowest",
+        required=False,
+        help="Number of slowest files listed per step in the metrics. default=10",
+        type=int,
+        default=10,
+    )
+
+    parser.add_argument(
+        "--profile_stage",
+        required=False,
+        help="Profile this step with cProfile, the profile of each source is written \
+            next to the --metrics file. Use -j 1 to also profile the conversions.",
+        choices=STAGES,
+        default=None,
+    )
+
     parser.add_argument(
         "-output",
         "--output_folder",
@@ -321,6 +1143,8 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.shard and args.merge_shards:
+        parser.error("--shard and -merge cannot be used together")
 
     # Source handler
     source_file = args.input_source_json
@@ -329,32 +1153,223 @@ def main():
     # Output folder
     output = args.output_folder
     sources = source_handler.get_sources()
-    sources_names = source_handler.get_source_names_ascii()
+    manifests = load_manifests(
+        sources, output, use_hash=args.hash_inputs, fresh=args.force_rerun
+    )
 
-    # Step 1 generate folder structure unless instructed to not to
-    # Skip if already generated for all sources
-    if not args.skip_folder_structure:
-        generate_folder_structure(sources_names, output)
+    metrics = None
+    if args.metrics:
+        metrics = Metrics(slowest=args.metrics_slowest, profile=args.profile_stage)
 
-    # Step 2 Generate the matching maps file
-    # In case of some audio file not matching some text file or vise verse
-    # Make a matching mapping file for each source
-    make_matching_maps(sources, output)
+    def measured(stage, source_name, function):
+        if not metrics:
+            return function
+        return metrics.wrap(stage, source_name, function, args.metrics)
 
-    # Step 3 Copy/Generate symlinks to audio files
-    if args.copy_audio or args.convert_to_wave:
-        generate_audio(sources, output, copy=True, wave=args.convert_to_wave)
+    # Step 0 Download the audio of the rss feeds
+    if args.download_audio:
+        from rss_handler.downloader import EpisodeDownloader
 
-    elif args.generate_audio_symlinks:
-        generate_audio(sources, output)
+        downloader = EpisodeDownloader(
+            workers=max(args.jobs, 4),
+            per_host=args.connections_per_host,
+            max_rate=args.max_download_rate,
+        )
+        _, downloaded = measured("download", "all", downloader.download_sources)(
+            sources
+        )
+        if metrics:
+            metrics.add(
+                "download",
+                "all",
+                files=len(downloaded),
+                bytes=sum(size for _, _, size in downloaded),
+            )
+
+    text_cache = None
+    if args.text_cache and not args.skip_convert_documents:
+        text_cache = TextCache(
+            args.text_cache_dir,
+            extractor_version(),
+            max_bytes=args.text_cache_size * 1024 * 1024,
+        )
+
+    # Steps 1 to 6 run per source as soon as the steps they need are done:
+    #
+    #   folders -> recovery -> matching -> audio -> standardize -> pack
+    #                                   \-> text  -/
+    #
+    # so sources, and the audio and text of a source, overlap. All of them
+    # share one pool of jobs worker processes for the heavy work.
+    executor = ProcessPoolExecutor(args.jobs) if args.jobs > 1 else None
+    scheduler = Scheduler(workers=args.jobs)
+
+    def add_step(stage, source_name, function, *step_args, **kwargs):
+        return scheduler.add(
+            f"{stage} of {source_name}",
+            measured(stage, source_name, function),
+            *step_args,
+            **kwargs,
+        )
+
+    for source in sources:
+        name = source.name_ascii
+        source_manifests = {name: manifests[name]}
+        inventories = {}
+        after = []
+
+        # Step 1 generate folder structure unless instructed to not to
+        if not args.skip_folder_structure:
+            after = [
+                add_step("folders", name, generate_folder_structure, [name], output)
+            ]
+
+        # Finish (or roll back) renames that an earlier run did not complete
+        after = [
+            add_step(
+                "recovery",
+                name,
+                recover_renames,
+                [source],
+                output,
+                source_manifests,
+                rollback=args.rollback_renames,
+                after=after,
+            )
+        ]
+
+        if args.merge_shards:
+            # Steps 2 to 4 were done by the --shard runs
+            after = [
+                add_step(
+                    "merging",
+                    name,
+                    merge_shards,
+                    [source],
+                    output,
+                    args.merge_shards,
+                    source_manifests,
+                    link_mode=args.link_mode or "reflink",
+                    metrics=metrics,
+                    after=after,
+                )
+            ]
+        else:
+            # Step 2 Generate the matching maps file
+            # In case of some audio file not matching some text file or vise verse
+            # Make a matching mapping file for the source, from one listing of
+            # its files that the audio and text steps share
+            matching = add_step(
+                "matching",
+                name,
+                __list_and_match,
+                source,
+                output,
+                inventories,
+                shard=args.shard,
+                metrics=metrics,
+                after=after,
+            )
+            after = [matching]
+
+            # Step 3 Copy/Generate symlinks to audio files
+            if args.copy_audio or args.convert_to_wave or args.link_mode:
+                after.append(
+                    add_step(
+                        "audio",
+                        name,
+                        generate_audio,
+                        [source],
+                        output,
+                        copy=True,
+                        wave=args.convert_to_wave,
+                        jobs=args.jobs,
+                        manifests=source_manifests,
+                        inventories=inventories,
+                        batch_size=args.ffmpeg_batch_size,
+                        link_mode=args.link_mode,
+                        executor=executor,
+                        metrics=metrics,
+                        after=[matching],
+                    )
+                )
+
+            elif args.generate_audio_symlinks:
+                after.append(
+                    add_step(
+                        "audio",
+                        name,
+                        generate_audio,
+                        [source],
+                        output,
+                        manifests=source_manifests,
+                        inventories=inventories,
+                        metrics=metrics,
+                        after=[matching],
+                    )
+                )
+
+            # Step 4 Generate the text files from documents
+            if not args.skip_convert_documents:
+                after.append(
+                    add_step(
+                        "text",
+                        name,
+                        generate_txt_files,
+                        [source],
+                        output,
+                        jobs=args.jobs,
+                        manifests=source_manifests,
+                        inventories=inventories,
+                        text_cache=text_cache,
+                        executor=executor,
+                        metrics=metrics,
+                        after=[matching],
+                    )
+                )
+
+        # Step 5 Standardize file names in and outside of mappings file
+        # The numbers of a part are only known once the parts are merged
+        if not args.skip_mapping and not args.shard:
+            after = [
+                add_step(
+                    "standardization",
+                    name,
+                    map_and_standardize_filenames,
+                    [source],
+                    output,
+                    manifests=source_manifests,
+                    files_per_folder=args.files_per_folder,
+                    metrics=metrics,
+                    after=after,
+                )
+            ]
+
+        # Step 6 Pack the standardized files into tar shards
+        if args.pack_shards and not args.shard:
+            add_step(
+                "packing",
+                name,
+                pack_sources,
+                [source],
+                output,
+                shard_size=args.shard_size * 1024 * 1024,
+                jobs=args.jobs,
+                executor=executor,
+                metrics=metrics,
+                after=after,
+            )
 
-    # Step 4 Generate the text files from documents
-    if not args.skip_convert_documents:
-        generate_txt_files(sources, output)
+    try:
+        failed = scheduler.run()
+    finally:
+        if executor:
+            executor.shutdown()
+    if failed:
+        logging.error(f"{len(failed)} steps failed or were skipped: {failed}")
 
-    # Step 5 Standardize file names in and outside of mappings file
-    if not args.skip_mapping:
-        map_and_standardize_filenames(sources, output)
+    if metrics:
+        metrics.save(args.metrics)
 
 
 if __name__ == "__main__":
@@ -10,4 +10,8 @@ ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
 from setuptools import setup, find_packages
 
-setup(name="speech-corpus-tools", version="1.0", packages=find_packages())
+setup(
+    name="speech-corpus-tools",
+    version="1.0",
+    packages=find_packages(exclude=["benchmarks"]),
+)
@@ -19,6 +19,7 @@ ___license___ = "Apache 2.0"
 ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
 import json
+from document_handler.extractors import MODES
 from utilities.utilities import standardize_string
 import logging
 
@@ -31,11 +32,18 @@ class Headers(object):
     TEXT_DIR = "text_dir"
     AUDIO_DIR = "audio_dir"
     MAPPING_FILE = "mapping_file"
+    TEXT_EXTRACTION = "text_extraction"
 
 
 class Source:
     def __init__(
-        self, name, text_dir=None, audio_dir=None, rss_feed_url=None, mapping_file=None
+        self,
+        name,
+        text_dir=None,
+        audio_dir=None,
+        rss_feed_url=None,
+        mapping_file=None,
+        text_extraction="fidelity",
     ) -> None:
         self.name = name
         self.name_ascii = standardize_string(name)
@@ -43,6 +51,8 @@ class Source:
         self.audio_path = audio_dir
         self.rss_feed_url = rss_feed_url
         self.mapping_file = mapping_file
+        # "fidelity" or "speed", see document_handler.extractors
+        self.text_extraction = text_extraction
 
 
 class SourceHandler:
@@ -115,6 +125,13 @@ class SourceHandler:
                     Skipping this source..."
             )
             return False
+        if source.text_extraction not in MODES:
+            logging.warning(
+                f"Source '{source.name}' has the unknown text_extraction \
+                    '{source.text_extraction}', known are {list(MODES)}. \
+                    Skipping this source..."
+            )
+            return False
 
         return True
 
@@ -126,6 +143,8 @@ class SourceHandler:
             text_dir = source[Headers.TEXT_DIR]
             audio_dir = source[Headers.AUDIO_DIR]
             mapping_file = source[Headers.MAPPING_FILE]
+            # Optional, keeps the page layout unless asked to go for speed
+            text_extraction = source.get(Headers.TEXT_EXTRACTION) or "fidelity"
 
             source_to_add = Source(
                 name=name,
@@ -133,6 +152,7 @@ class SourceHandler:
                 audio_dir=audio_dir,
                 rss_feed_url=url,
                 mapping_file=mapping_file,
+                text_extraction=text_extraction,
             )
 
             # Validate each source before adding
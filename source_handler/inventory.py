@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the SourceInventory class. It lists the audio and
+    text files of a source in a single os.scandir pass and keeps the stat
+    result of every file, so the pipeline steps never have to walk or stat
+    the (possibly network mounted) source folders again.
+
+    Example:
+
+    inventories = build_inventories(sources)
+    inventory = inventories[source.name_ascii]
+    if "episode_1.mp3" in inventory.audio:
+        path, stat = inventory.audio["episode_1.mp3"]
+
+    EXTEND AS FUNCTIONALITY IS EXTENDED
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from collections import namedtuple
+import logging
+import os
+
+InventoryFile = namedtuple("InventoryFile", ["path", "stat"])
+
+
+def scan_folder(folder) -> dict:
+    """
+    Returns {file name: InventoryFile} for all files in folder and its sub
+    folders. Like os.walk symlinked folders are not followed.
+    """
+    files = {}
+    if not folder or not os.path.isdir(folder):
+        return files
+
+    folders = [folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    logging.warning(f"Cannot stat '{entry.path}', skipping it")
+                    continue
+                if entry.name in files:
+                    logging.warning(
+                        f"Duplicate file name '{entry.name}' found in {folder}"
+                    )
+                files[entry.name] = InventoryFile(entry.path, stat)
+    return files
+
+
+class SourceInventory:
+    def __init__(self, source) -> None:
+        self.name = source.name_ascii
+        self.audio = scan_folder(source.audio_path)
+        self.text = scan_folder(source.text_dir)
+
+
+def build_inventories(sources: list) -> dict:
+    """Returns a {source.name_ascii: SourceInventory} dict for the sources"""
+    return {source.name_ascii: SourceInventory(source) for source in sources}
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+    Tests that a re-run of run.py, after rows were removed from a mapping
+    file and added again, gives the same output as a fresh run.
+
+    Run with
+    python -m pytest tests
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import filecmp
+import subprocess
+import sys
+from pathlib import Path
+
+from benchmarks.synthetic_corpus import make_corpus, write_docx, write_wav
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+
+def run(sources_json, output, *args) -> None:
+    subprocess.run(
+        [sys.executable, "run.py", "-i", str(sources_json), "-o", str(output), *args],
+        cwd=REPOSITORY,
+        check=True,
+        capture_output=True,
+    )
+
+
+def assert_same_files(folder, other) -> None:
+    for stage in ("audio", "text"):
+        names = sorted(path.name for path in (folder / stage).iterdir())
+        assert names == sorted(path.name for path in (other / stage).iterdir())
+        _, mismatch, errors = filecmp.cmpfiles(
+            folder / stage, other / stage, names, shallow=False
+        )
+        assert not mismatch and not errors
+    assert filecmp.cmp(folder / "mapping.tsv", other / "mapping.tsv", shallow=False)
+
+
+def test_remove_and_add_again_a_row(tmp_path):
+    sources_json = make_corpus(tmp_path / "corpus", sources=1, pairs=5, missing=0)
+    source = tmp_path / "corpus" / "source_0"
+    write_wav(source / "audio" / "new.wav", seed=999)
+    write_docx(source / "text" / "new.docx", ["the new row"])
+    mapping_file = source / "map.tsv"
+    header, *rows = mapping_file.read_text().splitlines(keepends=True)
+    with_new_row = "".join([header, "new.docx\tnew.wav\n", *rows])
+
+    output = tmp_path / "output"
+    mapping_file.write_text(with_new_row)
+    run(sources_json, output, "-ca")
+    mapping_file.write_text("".join([header, *rows]))
+    run(sources_json, output, "-ca")
+    mapping_file.write_text(with_new_row)
+    run(sources_json, output, "-ca")
+
+    fresh = tmp_path / "fresh"
+    run(sources_json, fresh, "-ca")
+    folder = output / "synthetic_0"
+    assert_same_files(folder, fresh / "synthetic_0")
+    assert (folder / "audio" / "synthetic_0_000001.wav").exists()
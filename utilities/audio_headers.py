@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+    This module reads the duration of audio files from their headers,
+    without decoding any audio.
+
+    The functions take a reader, any object with a read(offset, size) method
+    returning bytes and a size attribute with the size of the whole file,
+    which has to be known after the first read. That way the same code works
+    for local files (FileReader) and for remote files read with HTTP Range
+    requests, where only a few KB of each file are transferred.
+
+    Supported formats:
+    wav: the fmt and data chunks
+    mp3: Xing/Info or VBRI frame counts, otherwise the bitrate of the first
+        frame (CBR)
+    mp4/m4a: the mvhd atom of the moov atom, wherever it is in the file
+
+    Example:
+
+    with FileReader("episode.mp3") as reader:
+        seconds = audio_duration(reader)  # None if the format is unknown
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from collections import namedtuple
+import os
+import struct
+
+HEAD_SIZE = 16 * 1024
+
+# format_tag 1 is PCM, data_offset and data_size give the samples
+WavInfo = namedtuple(
+    "WavInfo",
+    ["format_tag", "channels", "sample_rate", "bits", "data_offset", "data_size"],
+)
+
+# kbps by [version is MPEG1][layer]
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Hz by version bits
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000]}
+MP3_SAMPLE_RATES[0] = [rate // 2 for rate in MP3_SAMPLE_RATES[2]]
+
+
+class FileReader:
+    """A reader for a local file"""
+
+    def __init__(self, path) -> None:
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class HeadCachingReader:
+    """Wraps a reader and keeps its first bytes so they are only read once"""
+
+    def __init__(self, reader, head_size=HEAD_SIZE) -> None:
+        self.reader = reader
+        self.head = reader.read(0, head_size)
+        self.size = reader.size
+
+    def read(self, offset: int, size: int) -> bytes:
+        if offset + size <= len(self.head) or len(self.head) >= self.size:
+            return self.head[offset : offset + size]
+        return self.reader.read(offset, size)
+
+
+def wav_info(reader):
+    """Returns the WavInfo of a RIFF/WAVE file or None"""
+    head = reader.read(0, 12)
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return None
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= reader.size:
+        chunk_id, chunk_size = struct.unpack("<4sI", reader.read(offset, 8))
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", reader.read(offset + 8, 16))
+        elif chunk_id == b"data" and fmt:
+            data_size = min(chunk_size, reader.size - offset - 8)
+            return WavInfo(fmt[0], fmt[1], fmt[2], fmt[5], offset + 8, data_size)
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def wav_duration(reader):
+    info = wav_info(reader)
+    if not info or not info.sample_rate or not info.bits or not info.channels:
+        return None
+    return info.data_size / (info.sample_rate * info.channels * info.bits // 8)
+
+
+def __mp3_frame(data: bytes, offset: int):
+    """Returns (is_mpeg1, layer, bitrate, sample_rate, mono, length) or None"""
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack(">I", data[offset : offset + 4])[0]
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 3
+    layer = 4 - ((header >> 17) & 3)
+    bitrate_index = (header >> 12) & 15
+    rate_index = (header >> 10) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    is_mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header >> 9) & 1
+    mono = (header >> 6) & 3 == 3
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        length = (144 if is_mpeg1 or layer == 2 else 72) * bitrate // sample_rate
+        length += padding
+    return is_mpeg1, layer, bitrate, sample_rate, mono, length
+
+
+def id3v2_size(head: bytes) -> int:
+    """The number of bytes taken by an ID3v2 tag at the start of a file"""
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in head[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def mp3_duration(reader):
+    start = id3v2_size(reader.read(0, 10))
+    data = reader.read(start, HEAD_SIZE)
+
+    # Find the first frame whose successor is where it says it is
+    for offset in range(len(data) - 4):
+        frame = __mp3_frame(data, offset)
+        if not frame:
+            continue
+        if offset + frame[5] + 4 <= len(data) and not __mp3_frame(
+            data, offset + frame[5]
+        ):
+            continue
+        break
+    else:
+        return None
+
+    is_mpeg1, layer, bitrate, sample_rate, mono, _ = frame
+    samples_per_frame = {1: 384, 2: 1152, 3: 1152 if is_mpeg1 else 576}[layer]
+
+    side_info = (17 if mono else 32) if is_mpeg1 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", data[xing + 4 : xing + 8])[0]
+        if flags & 1:
+            frames = struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+            return frames * samples_per_frame / sample_rate
+    vbri = offset + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI":
+        frames = struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+        return frames * samples_per_frame / sample_rate
+
+    audio_size = reader.size - start - offset
+    return audio_size * 8 / bitrate
+
+
+def __atoms(reader, start: int, end: int):
+    """Yields (type, offset, size) of the atoms between start and end"""
+    offset = start
+    while offset + 8 <= end:
+        header = reader.read(offset, 16)
+        size, kind = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield kind, offset + header_size, size - header_size
+        offset += size
+
+
+def mp4_duration(reader):
+    for kind, offset, size in __atoms(reader, 0, reader.size):
+        if kind != b"moov":
+            continue
+        for child, child_offset, _ in __atoms(reader, offset, offset + size):
+            if child != b"mvhd":
+                continue
+            mvhd = reader.read(child_offset, 32)
+            if mvhd[0] == 1:
+                timescale, duration = struct.unpack(">IQ", mvhd[20:32])
+            else:
+                timescale, duration = struct.unpack(">II", mvhd[12:20])
+            return duration / timescale if timescale else None
+    return None
+
+
+def audio_duration(reader):
+    """
+    Returns the duration in seconds of the audio file behind reader, read
+    from its headers, or None if the format is unknown or unreadable.
+    """
+    reader = HeadCachingReader(reader)
+    head = reader.head
+    try:
+        if head[:4] == b"RIFF":
+            return wav_duration(reader)
+        if head[4:8] == b"ftyp":
+            return mp4_duration(reader)
+        return mp3_duration(reader)
+    except struct.error:
+        return None
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the SourceManifest class. It keeps track of which
+    inputs of a source have already been turned into outputs so re-runs only
+    have to process new or changed files.
+
+    The manifest is stored as manifest.json in the output folder of each
+    source and has one section per output folder (stage):
+
+    {
+        "audio": {
+            "original_name.mp3": {
+                "input": "/path/to/original_name.mp3",
+                "size": 1234,
+                "mtime": 1650000000000000000,
+                "hash": "sha1 of the input, only with use_hash",
+                "mode": "wave",
+                "output": "source_name_000001.wav"
+            }
+        },
+        "text": {...}
+    }
+
+    The output is relative to destination / source_name / stage and follows
+    the file when it is renamed by standardize_files.
+
+    Example:
+
+    manifest = SourceManifest(Path(destination, source_name))
+    if not manifest.is_current("audio", name, input_path, mode="wave"):
+        ...
+        manifest.record("audio", name, input_path, output_name, mode="wave")
+    manifest.save()
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+
+def file_hash(path, chunk_size=1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SourceManifest:
+    FILENAME = "manifest.json"
+
+    def __init__(self, folder, use_hash=False, fresh=False) -> None:
+        """
+        folder is the output folder of the source, destination / source_name.
+        With use_hash the content hash of the inputs is recorded and used to
+        accept inputs that were touched but not changed.
+        With fresh the stored manifest is ignored and every input is
+        processed again.
+        """
+        self.folder = Path(folder)
+        self.path = self.folder / self.FILENAME
+        self.use_hash = use_hash
+        self.entries = {}
+        self.changed = False
+        # The audio and text of a source may be made at the same time
+        self.lock = threading.RLock()
+
+        if not fresh and self.path.exists():
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                logging.warning(f"Could not read {self.path}, starting a new one")
+
+    def __stage(self, stage) -> dict:
+        with self.lock:
+            return self.entries.setdefault(stage, {})
+
+    def output(self, stage, name):
+        """Returns the recorded output of name in stage or None"""
+        entry = self.__stage(stage).get(name)
+        return entry["output"] if entry else None
+
+    def outputs(self, stage) -> dict:
+        """Returns a {name: output} dict of every recorded output in stage"""
+        with self.lock:
+            return {
+                name: entry["output"] for name, entry in self.__stage(stage).items()
+            }
+
+    def entry(self, stage, name):
+        """Returns a copy of the entry of name in stage or None"""
+        with self.lock:
+            entry = self.__stage(stage).get(name)
+            return dict(entry) if entry else None
+
+    def add_entry(self, stage, name, entry) -> None:
+        """Stores an entry as is, e.g. one taken from another manifest"""
+        with self.lock:
+            self.__stage(stage)[name] = dict(entry)
+            self.changed = True
+
+    def output_path(self, stage, name):
+        output = self.output(stage, name)
+        return self.folder / stage / output if output else None
+
+    def is_current(self, stage, name, input_path, mode=None, stat=None) -> bool:
+        """
+        True if the input has not changed since its output was recorded and
+        the output is still there.
+        """
+        entry = self.__stage(stage).get(name)
+        if not entry or entry.get("mode") != mode:
+            return False
+        if not os.path.lexists(self.output_path(stage, name)):
+            return False
+
+        stat = stat or os.stat(input_path)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if self.use_hash and entry.get("hash") == file_hash(input_path):
+            with self.lock:
+                entry["mtime"] = stat.st_mtime_ns
+                self.changed = True
+            return True
+        return False
+
+    def record(
+        self, stage, name, input_path, output, mode=None, stat=None, **details
+    ) -> None:
+        """details are stored with the entry, e.g. how the output was made"""
+        stat = stat or os.stat(input_path)
+        entry = {
+            "input": str(input_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "mode": mode,
+            "output": str(output),
+        }
+        entry.update(details)
+        if self.use_hash:
+            entry["hash"] = file_hash(input_path)
+        with self.lock:
+            self.__stage(stage)[name] = entry
+            self.changed = True
+
+    def set_output(self, stage, name, output) -> None:
+        with self.lock:
+            entry = self.__stage(stage).get(name)
+            if entry:
+                entry["output"] = str(output)
+                self.changed = True
+
+    def forget(self, stage, name) -> None:
+        """
+        Drops the entry of name and removes its old output so that it can be
+        generated again.
+        """
+        old_output = self.output_path(stage, name)
+        with self.lock:
+            if self.__stage(stage).pop(name, None):
+                self.changed = True
+        if old_output and os.path.lexists(old_output):
+            os.remove(old_output)
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.changed:
+                return
+            tmp_path = self.path.with_suffix(".json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, ensure_ascii=False, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+
+
+def load_manifests(sources: list, destination, use_hash=False, fresh=False) -> dict:
+    """Returns a {source.name_ascii: SourceManifest} dict for the sources"""
+    return {
+        source.name_ascii: SourceManifest(
+            Path(destination, source.name_ascii), use_hash=use_hash, fresh=fresh
+        )
+        for source in sources
+    }
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+    This module puts a copy of a file somewhere else as cheaply as the file
+    system allows. What a copy means is chosen with a link mode:
+
+    symlink: a symbolic link, free but breaks when the output is moved
+    hardlink: a hard link, free on the same file system, else a copy
+    reflink: a copy on write clone (FICLONE on btrfs/xfs), else a hard link,
+        else a copy
+    copy: a real copy, done in the kernel with os.copy_file_range if possible
+
+    materialize returns the method that was actually used, so callers can
+    report it.
+
+    Example:
+
+    method = materialize("input.wav", "output/input.wav", "reflink")
+    # -> "reflink", "hardlink" or "copy"
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+import errno
+import os
+import shutil
+
+LINK_MODES = ("symlink", "hardlink", "reflink", "copy")
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean the method is not possible here, not that the file is bad
+UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.ENOSYS,
+    errno.EMLINK,
+}
+
+
+def reflink(input, output) -> None:
+    import fcntl
+
+    with open(input, "rb") as source, open(output, "wb") as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(output)
+            raise
+
+
+def copy(input, output) -> None:
+    """Copies in the kernel with os.copy_file_range where available"""
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(input, output)
+        return
+    with open(input, "rb") as source, open(output, "wb") as destination:
+        size = os.fstat(source.fileno()).st_size
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(
+                    source.fileno(), destination.fileno(), size - copied
+                )
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            source.seek(0)
+            destination.seek(0)
+            destination.truncate()
+            shutil.copyfileobj(source, destination)
+
+
+METHODS = {
+    "symlink": os.symlink,
+    "hardlink": os.link,
+    "reflink": reflink,
+    "copy": copy,
+}
+
+FALLBACKS = {
+    "symlink": ["symlink"],
+    "hardlink": ["hardlink", "copy"],
+    "reflink": ["reflink", "hardlink", "copy"],
+    "copy": ["copy"],
+}
+
+
+def materialize(input, output, mode="copy") -> str:
+    """
+    Makes input available at output in the given link mode, falling back to
+    the next method when the file system does not support one. An existing
+    output is replaced, the file it points to is left alone.
+
+    Returns the method that was used.
+    """
+    if mode not in FALLBACKS:
+        raise ValueError(f"Unknown link mode '{mode}', known modes are {LINK_MODES}")
+
+    # Every method writes a new file that then replaces output, an existing
+    # output may be a link to input and must never be opened for writing
+    tmp_output = f"{output}.{os.getpid()}.tmp"
+    methods = FALLBACKS[mode]
+    for method in methods:
+        try:
+            METHODS[method](input, tmp_output)
+            os.replace(tmp_output, output)
+            return method
+        except OSError as e:
+            if e.errno not in UNSUPPORTED or method == methods[-1]:
+                raise
+        finally:
+            # Also left when output already was a hard link to input, replacing
+            # a link with a link to the same file does nothing
+            if os.path.lexists(tmp_output):
+                os.remove(tmp_output)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the Metrics class, which records where a run of
+    run.py spends its time and writes it as a JSON report (--metrics).
+
+    For every stage, in total and per source:
+    seconds: wall time of the stage, summed over sources
+    cpu_seconds: CPU time of the thread running the stage
+    worker_cpu_seconds: CPU time spent in pool workers and their ffmpeg
+        processes for the stage
+    files, bytes and bytes_per_second: what the stage processed
+    other counters that a stage adds, e.g. unmatched_rows of matching
+    peak_rss_mb: the peak memory of run.py when the stage ended
+    peak_worker_rss_mb: the peak memory of the pool workers of the stage
+    slowest: the slowest files of the stage, only for the whole stage
+
+    One stage can also be profiled with cProfile, the profile of each
+    source is dumped next to the report as report.stage.source.prof.
+
+    Example:
+
+    metrics = Metrics(slowest=10, profile="text")
+    with metrics.measure("text", source_name, "report.json"):
+        ...
+        metrics.add_file("text", source_name, path, size, seconds)
+    metrics.save("report.json")
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from contextlib import contextmanager
+import cProfile
+import heapq
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+COUNTERS = [
+    "seconds",
+    "cpu_seconds",
+    "worker_cpu_seconds",
+    "files",
+    "bytes",
+    "peak_rss_mb",
+    "peak_worker_rss_mb",
+]
+# Only one profiler can be active at a time on newer Pythons
+PROFILE_LOCK = threading.Lock()
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    """The peak resident memory of this process, or of its children, in MB"""
+    peak = resource.getrusage(who).ru_maxrss
+    # KB on linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def timed_call(function, *args) -> tuple:
+    """
+    Runs function(*args) and returns (result, wall seconds, cpu seconds,
+    peak rss in MB), the CPU time includes the processes it waited for,
+    e.g. ffmpeg.
+    """
+    wall, cpu, children = (
+        time.perf_counter(),
+        time.thread_time(),
+        children_cpu_seconds(),
+    )
+    result = function(*args)
+    cpu = time.thread_time() - cpu + children_cpu_seconds() - children
+    return result, time.perf_counter() - wall, cpu, peak_rss_mb()
+
+
+class Metrics:
+    def __init__(self, slowest=10, profile=None) -> None:
+        """
+        slowest is the number of files listed for each stage. profile is the
+        name of a stage to run under cProfile.
+        """
+        self.slowest = slowest
+        self.profile = profile
+        self.stages = {}
+        self.files = {}
+        self.lock = threading.Lock()
+        self.start = (time.perf_counter(), time.process_time())
+
+    def __counters(self, stage, source) -> dict:
+        sources = self.stages.setdefault(stage, {})
+        return sources.setdefault(source, dict.fromkeys(COUNTERS, 0))
+
+    def add(self, stage, source, **counters) -> None:
+        """Adds to the counters of stage and source, peaks keep their maximum"""
+        with self.lock:
+            totals = self.__counters(stage, source)
+            for name, value in counters.items():
+                if name.startswith("peak_"):
+                    totals[name] = max(totals.get(name, 0), value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+
+    def add_file(
+        self,
+        stage,
+        source,
+        name,
+        size,
+        seconds,
+        cpu_seconds=None,
+        peak_rss=None,
+        files=1,
+    ) -> None:
+        """
+        Counts a file, or files processed together, of stage. cpu_seconds
+        and peak_rss are given for files processed by pool workers.
+        """
+        counters = {"files": files, "bytes": size}
+        if cpu_seconds is not None:
+            counters["worker_cpu_seconds"] = cpu_seconds
+        if peak_rss is not None:
+            counters["peak_worker_rss_mb"] = peak_rss
+        self.add(stage, source, **counters)
+        with self.lock:
+            slowest = self.files.setdefault(stage, [])
+            entry = (seconds, str(name), source, size)
+            if len(slowest) < self.slowest:
+                heapq.heappush(slowest, entry)
+            elif self.slowest:
+                heapq.heappushpop(slowest, entry)
+
+    @contextmanager
+    def measure(self, stage, source, report_path=None):
+        """Measures the time and memory of stage for source"""
+        profiler = None
+        if stage == self.profile:
+            PROFILE_LOCK.acquire()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield self
+        finally:
+            self.add(
+                stage,
+                source,
+                seconds=time.perf_counter() - wall,
+                cpu_seconds=time.thread_time() - cpu,
+                peak_rss_mb=peak_rss_mb(),
+            )
+            if profiler:
+                profiler.disable()
+                PROFILE_LOCK.release()
+                if report_path:
+                    report_path = Path(report_path)
+                    profiler.dump_stats(
+                        report_path.with_name(
+                            f"{report_path.stem}.{stage}.{source}.prof"
+                        )
+                    )
+
+    def wrap(self, stage, source, function, report_path=None):
+        """Returns function measured as stage for source"""
+
+        def measured(*args, **kwargs):
+            with self.measure(stage, source, report_path):
+                return function(*args, **kwargs)
+
+        return measured
+
+    def report(self) -> dict:
+        def with_rate(counters):
+            counters = dict(counters)
+            seconds = counters["seconds"]
+            counters["bytes_per_second"] = counters["bytes"] / seconds if seconds else 0
+            return counters
+
+        stages = {}
+        for stage, sources in self.stages.items():
+            total = dict.fromkeys(COUNTERS, 0)
+            for counters in sources.values():
+                for name, value in counters.items():
+                    if name.startswith("peak_"):
+                        total[name] = max(total.get(name, 0), value)
+                    else:
+                        total[name] = total.get(name, 0) + value
+            stages[stage] = with_rate(total)
+            stages[stage]["sources"] = {
+                source: with_rate(counters) for source, counters in sources.items()
+            }
+            stages[stage]["slowest"] = [
+                {"file": name, "source": source, "seconds": seconds, "bytes": size}
+                for seconds, name, source, size in sorted(
+                    self.files.get(stage, []), reverse=True
+                )
+            ]
+
+        wall, cpu = self.start
+        return {
+            "run": {
+                "argv": sys.argv,
+                "seconds": time.perf_counter() - wall,
+                "cpu_seconds": time.process_time() - cpu,
+                "children_cpu_seconds": children_cpu_seconds(),
+                "peak_rss_mb": peak_rss_mb(),
+                "peak_children_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            },
+            "stages": stages,
+        }
+
+    def save(self, path) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp_path, path)
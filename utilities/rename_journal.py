@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the RenameJournal class which renames the files of
+    a source in bulk so that an interruption can always be resumed or rolled
+    back.
+
+    Before anything is renamed the whole rename plan and the new mapping are
+    written to the folder of the source:
+
+    rename_journal.tsv: one row per file with the columns
+        stage: the folder of the file, audio or text
+        original: the original name of the file, as in the manifest
+        current: the name of the file now
+        temporary: a name to park the file under while another file still
+            holds its target, empty if not needed
+        target: the name of the file when done
+    mapping.pending.tsv: the mapping.tsv to use once the renames are done
+
+    The renames are then applied in two phases, first the files that need a
+    temporary name are parked, then every file is moved to its target. The
+    start of the second phase is marked with rename_journal.phase2. Once all
+    files are in place the pending mapping replaces mapping.tsv and the
+    journal is removed.
+
+    Example:
+
+    journal = RenameJournal(Path(destination, source_name))
+    if journal.exists():
+        journal.apply()  # or journal.rollback()
+    journal.start(plan, new_mapping)
+    journal.apply()
+    journal.finish()
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+PLAN_COLUMNS = ["stage", "original", "current", "temporary", "target"]
+
+
+class RenameJournal:
+    FILENAME = "rename_journal.tsv"
+    PHASE_2 = "rename_journal.phase2"
+    PENDING_MAPPING = "mapping.pending.tsv"
+
+    def __init__(self, folder, workers=8) -> None:
+        """
+        folder is the output folder of the source, destination / source_name.
+        workers renames run at a time, which hides the latency of network
+        file systems.
+        """
+        self.folder = Path(folder)
+        self.path = self.folder / self.FILENAME
+        self.phase_2 = self.folder / self.PHASE_2
+        self.pending_mapping = self.folder / self.PENDING_MAPPING
+        self.workers = workers
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def __write(self, dataframe: "pd.DataFrame", path: Path) -> None:
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        dataframe.to_csv(tmp_path, sep="\t", index=False)
+        os.replace(tmp_path, path)
+
+    def start(self, plan: "pd.DataFrame", mapping: "pd.DataFrame") -> None:
+        """Writes the plan and the new mapping, the plan last as the marker"""
+        self.__write(mapping, self.pending_mapping)
+        self.__write(plan[PLAN_COLUMNS], self.path)
+
+    def plan(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        return pd.read_csv(self.path, sep="\t", dtype=str, keep_default_na=False)
+
+    def __rename_all(self, renames: list) -> None:
+        def rename(paths):
+            source, destination = paths
+            if os.path.lexists(source):
+                os.rename(source, destination)
+            elif not os.path.lexists(destination):
+                logging.error(f"Cannot find {source} to rename it to {destination}")
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            list(executor.map(rename, renames))
+
+    def __paths(self, plan: "pd.DataFrame", column: str) -> list:
+        return [
+            self.folder / stage / name for stage, name in zip(plan.stage, plan[column])
+        ]
+
+    def __sources(self, plan: "pd.DataFrame") -> list:
+        """Where each file is moved to its target from in the second phase"""
+        return [
+            self.folder / stage / (temporary or current)
+            for stage, current, temporary in zip(
+                plan.stage, plan.current, plan.temporary
+            )
+        ]
+
+    def apply(self) -> "pd.DataFrame":
+        """
+        Applies the renames of the journal, skipping those that are already
+        done, and returns the plan.
+        """
+        plan = self.plan()
+        parked = plan[plan.temporary != ""]
+
+        if not self.phase_2.exists():
+            self.__rename_all(
+                list(
+                    zip(
+                        self.__paths(parked, "current"),
+                        self.__paths(parked, "temporary"),
+                    )
+                )
+            )
+            self.phase_2.touch()
+
+        sources = self.__sources(plan)
+        targets = self.__paths(plan, "target")
+        for folder in {target.parent for target in targets}:
+            folder.mkdir(parents=True, exist_ok=True)
+        self.__rename_all(list(zip(sources, targets)))
+        return plan
+
+    def rollback(self) -> None:
+        """Moves every file back to its name before the journal was started"""
+        plan = self.plan()
+        parked = plan[plan.temporary != ""]
+
+        if self.phase_2.exists():
+            sources = self.__sources(plan)
+            targets = self.__paths(plan, "target")
+            self.__rename_all(
+                [
+                    (target, source)
+                    for source, target in zip(sources, targets)
+                    if not os.path.lexists(source)
+                ]
+            )
+        self.__rename_all(
+            list(
+                zip(self.__paths(parked, "temporary"), self.__paths(parked, "current"))
+            )
+        )
+        # The subfolders apply made for the targets, if nothing else is in them
+        stage_folders = {self.folder / stage for stage in plan.stage}
+        for folder in {path.parent for path in self.__paths(plan, "target")}:
+            if folder not in stage_folders:
+                try:
+                    folder.rmdir()
+                except OSError:
+                    pass
+        self.__clear()
+
+    def finish(self) -> None:
+        """Puts the new mapping in place and removes the journal"""
+        os.replace(self.pending_mapping, self.folder / "mapping.tsv")
+        self.__clear()
+
+    def __clear(self) -> None:
+        for path in (self.pending_mapping, self.phase_2, self.path):
+            if path.exists():
+                path.unlink()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+    This module contains the Scheduler class, which runs tasks as soon as
+    the tasks they depend on are done instead of step by step.
+
+    Tasks run on a pool of threads of the given size, so independent tasks,
+    e.g. the audio of one source and the text of another, overlap. Heavy
+    work inside a task should go to a shared process pool, see
+    utilities.run_in_pool, so that all tasks together stay within one
+    worker budget.
+
+    A task that fails is logged and the tasks depending on it are skipped,
+    the rest keep going.
+
+    Example:
+
+    scheduler = Scheduler(workers=4)
+    scheduler.add("folders", make_folders)
+    scheduler.add("audio", make_audio, after=["folders"])
+    scheduler.add("text", make_text, after=["folders"])
+    scheduler.add("rename", rename, after=["audio", "text"])
+    failed = scheduler.run()  # names of the tasks that failed or were skipped
+"""
+
+___author___ = "Staffan Hedström"
+___license___ = "Apache 2.0"
+___copyright___ = "2022 Staffan Hedström Reykjavík University"
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+
+
+class Scheduler:
+    def __init__(self, workers=1) -> None:
+        self.workers = max(workers, 1)
+        self.tasks = {}
+        self.dependencies = {}
+
+    def add(self, name, function, *args, after=(), **kwargs) -> str:
+        """
+        Adds function(*args, **kwargs) as the task name, to run once the
+        tasks in after are done. Returns the name.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' was already added")
+        unknown = [dependency for dependency in after if dependency not in self.tasks]
+        if unknown:
+            raise ValueError(f"Task '{name}' depends on unknown tasks {unknown}")
+        self.tasks[name] = (function, args, kwargs)
+        self.dependencies[name] = set(after)
+        return name
+
+    def run(self) -> list:
+        """
+        Runs all tasks, in the order they were added among those that are
+        ready, and returns the names of the tasks that failed or were
+        skipped because a task they depend on failed.
+        """
+        waiting = {name: set(after) for name, after in self.dependencies.items()}
+        failed = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            running = {}
+
+            def submit_ready():
+                for name in [name for name, after in waiting.items() if not after]:
+                    del waiting[name]
+                    function, args, kwargs = self.tasks[name]
+                    running[executor.submit(function, *args, **kwargs)] = name
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        for after in waiting.values():
+                            after.discard(name)
+                        continue
+                    logging.error(f"{name} failed: {error!r}")
+                    failed.append(name)
+                    failed.extend(self.__skip(waiting, name))
+                submit_ready()
+        return failed
+
+    def __skip(self, waiting: dict, failed_name) -> list:
+        """Drops every waiting task that depends on failed_name"""
+        skipped = []
+        for name in [name for name, after in waiting.items() if failed_name in after]:
+            if name in waiting:
+                del waiting[name]
+                logging.error(f"Skipping {name}, {failed_name} failed")
+                skipped.append(name)
+                skipped.extend(self.__skip(waiting, name))
+        return skipped
@@ -7,6 +7,26 @@
     seconds_to_hours_mins(seconds) -> (hours, mins):
     Takes in seconds and outputs whole hours and whole minutes in a tuple
 
+    shard_of(name, shards) -> int:
+    The shard, 0 to shards - 1, that a file name belongs to, the same on
+    every machine
+
+    run_in_pool(function, arguments, jobs, description) -> [(args, result)]:
+    Runs function over a list of argument tuples on a bounded process pool,
+    or a shared executor, logging failures per item instead of stopping the
+    batch
+
+    cache_folder(name) -> Path:
+    The folder used for the on-disk cache with the given name
+
+    evict_least_recently_used(folder, max_bytes):
+    Removes the least recently used files of a cache folder until it fits
+
+    convert_batch_to_wav(pairs) -> [(input, wav)]:
+    Converts many (input, output) pairs to 16 kHz mono wav with a single
+    ffmpeg process, files that already have that format are only linked or
+    copied
+
     EXTEND AS FUNCTIONALITY IS EXTENDED
 """
 
@@ -14,8 +34,22 @@ ___author___ = "Staffan Hedström"
 ___license___ = "Apache 2.0"
 ___copyright___ = "2022 Staffan Hedström Reykjavík University"
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from functools import partial
+import logging
+import os
+from pathlib import Path
+import zlib
 import unidecode
-import ffmpeg
+from tqdm import tqdm
+
+from utilities.audio_headers import FileReader, wav_info
+from utilities.metrics import timed_call
+from utilities.materialize import materialize
+
+# The format all audio is converted to
+WAV_OPTIONS = {"f": "wav", "acodec": "pcm_s16le", "ac": 1, "ar": "16k"}
 
 
 def seconds_to_hours_mins(seconds):
@@ -28,24 +62,194 @@ def standardize_string(string):
     return unidecode.unidecode(string.lower().replace(" ", "_"))
 
 
-def copy_and_convert_to_wav(input, output):
-    """
-    Uses ffmpeg to convert the intput file to a .wav
-    and places a copy of it at output
-    """
+def shard_of(name: str, shards: int) -> int:
+    # crc32 and not hash(), which is salted differently in every process
+    return zlib.crc32(name.encode("utf-8")) % shards
+
+
+def to_wav_path(output) -> str:
+    """Makes a path end with .wav"""
     file_format = output.split(".")[-1]
     if file_format != "wav":
         output = output.split(".")
         output[-1] = "wav"
         output = ".".join(output)
+    return output
+
+
+def copy_and_convert_to_wav(input, output):
+    """
+    Uses ffmpeg to convert the intput file to a .wav
+    and places a copy of it at output
+
+    Returns the path of the .wav file
+    """
+    import ffmpeg
+
+    output = to_wav_path(output)
     stream = ffmpeg.input(input)
-    stream = ffmpeg.output(
-        stream,
-        filename=output,
-        f="wav",
-        acodec="pcm_s16le",
-        ac=1,
-        ar="16k",
-        loglevel="error",
-    )
+    stream = ffmpeg.output(stream, filename=output, loglevel="error", **WAV_OPTIONS)
     ffmpeg.run(stream)
+    return output
+
+
+def is_conformant_wav(path) -> bool:
+    """True if path is already a 16 kHz mono 16 bit PCM wav, read from its header"""
+    try:
+        with FileReader(path) as reader:
+            info = wav_info(reader)
+    except (IOError, ValueError):
+        return False
+    return bool(
+        info
+        and info.format_tag == 1
+        and info.channels == 1
+        and info.sample_rate == 16000
+        and info.bits == 16
+    )
+
+
+def convert_batch_to_wav(pairs: list, link_mode="copy") -> list:
+    """
+    Converts every (input, output) pair like copy_and_convert_to_wav, but
+    inputs that already are conformant wav files are materialized unchanged
+    in link_mode, see utilities.materialize, and the rest are converted by a
+    single ffmpeg process, saving the startup of one process per file. If
+    that process fails the files are converted one by one so a broken file
+    only fails itself.
+
+    Returns (input, wav path, method) for every pair that was converted,
+    method is "ffmpeg" or the materialize method used.
+    """
+    import ffmpeg
+
+    done = []
+    to_convert = []
+    for input, output in pairs:
+        if is_conformant_wav(input):
+            method = materialize(input, to_wav_path(output), link_mode)
+            done.append((input, to_wav_path(output), method))
+        else:
+            to_convert.append((input, to_wav_path(output)))
+
+    if len(to_convert) > 1:
+        # Without an explicit map per output ffmpeg picks the first output's
+        # stream among all inputs, and would map cover art into the wav files
+        streams = [
+            ffmpeg.input(input)["a:0"].output(output, **WAV_OPTIONS)
+            for input, output in to_convert
+        ]
+        try:
+            ffmpeg.merge_outputs(*streams).global_args(
+                "-loglevel", "error"
+            ).overwrite_output().run()
+            return done + [(input, output, "ffmpeg") for input, output in to_convert]
+        except (ffmpeg.Error, OSError):
+            # Clean up after the batch and find out which file is broken
+            for _, output in to_convert:
+                if os.path.exists(output):
+                    os.remove(output)
+
+    for input, output in to_convert:
+        try:
+            done.append((input, copy_and_convert_to_wav(input, output), "ffmpeg"))
+        except (ffmpeg.Error, OSError) as e:
+            logging.error(f"Cannot convert '{input}' to wav: {e!r}")
+    return done
+
+
+def run_in_pool(
+    function, arguments: list, jobs=1, description=None, executor=None, timings=None
+) -> list:
+    """
+    Runs function(*args) for every args tuple in arguments.
+
+    With jobs > 1 the calls are spread over a pool of worker processes, with
+    at most 2 * jobs calls queued at any time so huge batches do not pile up
+    in memory. A failing call is logged and skipped, the rest of the batch
+    keeps going.
+
+    With an executor the calls go to that pool instead, so several callers
+    can share one pool of jobs workers.
+
+    With a timings list every call is timed, see utilities.metrics, and
+    (args, wall seconds, cpu seconds, peak rss in MB, pooled) is appended to
+    it for every call that succeeded. pooled is False for calls that ran in
+    this process.
+
+    Returns a list of (args, result) for every call that succeeded.
+    """
+    results = []
+    progress = tqdm(total=len(arguments), desc=description)
+    pooled = executor is not None or jobs > 1
+    call = function if timings is None else partial(timed_call, function)
+
+    def collect(args, future_or_call):
+        try:
+            result = future_or_call()
+            if timings is not None:
+                result, *timing = result
+                timings.append((args, *timing, pooled))
+            results.append((args, result))
+        except Exception as e:
+            logging.error(f"{function.__name__}{args} failed: {e!r}")
+        progress.update()
+
+    if not pooled:
+        for args in arguments:
+            collect(args, lambda: call(*args))
+        progress.close()
+        return results
+
+    with nullcontext(executor) if executor else ProcessPoolExecutor(jobs) as executor:
+        pending = {}
+        for args in arguments:
+            if len(pending) >= 2 * jobs:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(pending.pop(future), future.result)
+            pending[executor.submit(call, *args)] = args
+        for future in wait(pending).done:
+            collect(pending.pop(future), future.result)
+    progress.close()
+    return results
+
+
+def cache_folder(name) -> Path:
+    """
+    Returns the folder of the on-disk cache called name, under
+    $XDG_CACHE_HOME or ~/.cache, and creates it if needed.
+    """
+    root = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    folder = Path(root, "speech-corpus-tools", name)
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+def evict_least_recently_used(folder, max_bytes) -> int:
+    """
+    Removes files from folder, least recently used first, until the files in
+    it take up at most max_bytes. Caches mark a file as used by touching it.
+
+    Returns the number of bytes removed.
+    """
+    files = []
+    total = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # Leave files that are still being written alone
+            if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+    removed = 0
+    for _, size, path in sorted(files):
+        if total - removed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += size
+        except FileNotFoundError:
+            pass
+    return removed